@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Host wide admission control for the exporters' heavy steps (compressing the tarball, uploading it
+# to VDI), so that a burst of exports does not saturate the node's CPU and uplink, or VDI's rate
+# limits.
+#
+# Every exporter process on the host coordinates through files in one directory (no daemon):
+#  - each resource has a fixed number of slot files.  An exporter holds a slot by holding an
+#    exclusive flock on its file, so slots are released by the kernel even if the job is killed.
+#    The holder writes its pid, user and size into the file, for the others to see
+#  - an exporter waiting for a slot writes a ticket into queue/.  Free slots go to the waiting
+#    tickets in priority order: users holding the fewest slots of the resource first (fairness),
+#    then small exports (up to small-export-bytes) ahead of large ones, then first come first served.
+#    Tickets of dead processes are removed by whoever finds them
+#
+# Configured by these (optional) config.json keys.  A resource without a cap is not controlled:
+#   max-concurrent-compressions      cap on tarballs being compressed at once
+#   max-concurrent-uploads           cap on tarballs being uploaded at once
+#   max-concurrent-exports-per-user  cap on the slots of a resource one user may hold (default none)
+#   small-export-bytes               exports up to this size go ahead of larger ones (default 64MB)
+#   admission-dir                    the shared directory (default /var/tmp/eupath-export-admission)
+
+DEFAULT_ADMISSION_DIR = "/var/tmp/eupath-export-admission"
+DEFAULT_SMALL_EXPORT_BYTES = 64 * 1024 * 1024
+POLL_SECONDS = 2.0
+
+# config key of the cap of each resource
+RESOURCE_CAPS = {"compress": "max-concurrent-compressions", "upload": "max-concurrent-uploads"}
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_json(path_or_fd):
+    """
+    :return: the JSON content of a ticket or slot file, or None if it is empty or unreadable
+    """
+    try:
+        if isinstance(path_or_fd, int):
+            content = os.pread(path_or_fd, 4096, 0)
+        else:
+            with open(path_or_fd, "rb") as f:
+                content = f.read()
+        return json.loads(content) if content else None
+    except (OSError, ValueError):
+        return None
+
+
+class AdmissionController:
+
+    def __init__(self, directory, caps, user, max_per_user=0, small_export_bytes=DEFAULT_SMALL_EXPORT_BYTES):
+        """
+        :param caps: the number of slots of each controlled resource, e.g. {"upload": 2}
+        :param user: the user the exports are for
+        :param max_per_user: the most slots of a resource one user may hold, or 0 for no limit
+        """
+        self._directory = directory
+        self._queue_directory = os.path.join(directory, "queue")
+        self._caps = caps
+        self._user = str(user)
+        self._max_per_user = max_per_user
+        self._small_export_bytes = small_export_bytes
+
+    @classmethod
+    def from_config(cls, config, user):
+        """
+        :param config: the parsed config.json
+        """
+        caps = {resource: int(config[key]) for resource, key in RESOURCE_CAPS.items() if int(config.get(key, 0)) > 0}
+        return cls(config.get("admission-dir", DEFAULT_ADMISSION_DIR), caps, user,
+                   int(config.get("max-concurrent-exports-per-user", 0)),
+                   int(config.get("small-export-bytes", DEFAULT_SMALL_EXPORT_BYTES)))
+
+    @contextmanager
+    def slot(self, resource, size):
+        """
+        Hold a slot of a resource for the enclosed code, waiting for one if they are all taken.
+        :param size: the size of the export in bytes, for prioritizing small exports
+        """
+        if resource not in self._caps:
+            yield
+            return
+
+        start = time.time()
+        fd = self._acquire(resource, size)
+        waited = time.time() - start
+        if waited >= POLL_SECONDS:
+            print("Waited %.0fs for a slot to %s" % (waited, resource), file=sys.stderr)
+        try:
+            yield
+        finally:
+            os.ftruncate(fd, 0)
+            os.close(fd)  # releases the lock
+
+    def _acquire(self, resource, size):
+        """
+        :return: the open, locked file descriptor of a slot
+        """
+        os.makedirs(self._queue_directory, mode=0o777, exist_ok=True)
+        ticket = self._write_ticket(resource, size)
+        announced = False
+        try:
+            while True:
+                free, holders = self._probe_slots(resource)
+                held = {}
+                for holder in holders:
+                    held[holder.get("user")] = held.get(holder.get("user"), 0) + 1
+
+                if free and self._may_hold(held, self._user):
+                    # waiting tickets that go before ours (a user at the per user cap can't take a slot)
+                    waiting = [t for t in self._waiting_tickets(resource, held) if self._may_hold(held, t["user"])]
+                    ahead = next((i for i, t in enumerate(waiting) if t["path"] == ticket), 0)
+                    if ahead < len(free):
+                        for path in free:
+                            fd = self._lock_slot(path, size)
+                            if fd is not None:
+                                return fd
+
+                if not announced:
+                    print("Waiting for a slot to %s (%d in use on this host)" % (resource, len(holders)), file=sys.stderr)
+                    announced = True
+                time.sleep(POLL_SECONDS)
+        finally:
+            try:
+                os.unlink(ticket)
+            except OSError:
+                pass
+
+    def _may_hold(self, held, user):
+        return not self._max_per_user or held.get(user, 0) < self._max_per_user
+
+    def _slot_paths(self, resource):
+        return [os.path.join(self._directory, "%s.slot%d" % (resource, i)) for i in range(self._caps[resource])]
+
+    def _probe_slots(self, resource):
+        """
+        :return: (paths of the free slots, holder info of the taken ones)
+        """
+        free = []
+        holders = []
+        for path in self._slot_paths(resource):
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                free.append(path)
+            except BlockingIOError:
+                holders.append(read_json(fd) or {})
+            finally:
+                os.close(fd)
+        return free, holders
+
+    def _lock_slot(self, path, size):
+        """
+        :return: the locked file descriptor of a slot, or None if it was taken first by another process
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, json.dumps({"pid": os.getpid(), "user": self._user, "size": size, "since": time.time()}).encode(), 0)
+        return fd
+
+    def _write_ticket(self, resource, size):
+        created = time.time()
+        # the thread too, as the parts of a sharded export wait in threads of one process
+        path = os.path.join(self._queue_directory, "%s.%d.%d.%d.ticket" % (resource, int(created * 1e6), os.getpid(), threading.get_ident()))
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as ticket:
+            json.dump({"pid": os.getpid(), "user": self._user, "size": size, "created": created}, ticket)
+        os.replace(temp_path, path)
+        return path
+
+    def _waiting_tickets(self, resource, held):
+        """
+        :param held: the number of slots of the resource each user holds
+        :return: the live tickets waiting for a resource, in priority order
+        """
+        tickets = []
+        for name in os.listdir(self._queue_directory):
+            if not (name.startswith(resource + ".") and name.endswith(".ticket")):
+                continue
+            path = os.path.join(self._queue_directory, name)
+            ticket = read_json(path)
+            if ticket is None:
+                continue
+            if not pid_alive(ticket["pid"]):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            ticket["path"] = path
+            tickets.append(ticket)
+        tickets.sort(key=lambda t: (held.get(t["user"], 0), t["size"] > self._small_export_bytes, t["created"], t["pid"]))
+        return tickets
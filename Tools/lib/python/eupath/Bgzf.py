@@ -0,0 +1,258 @@
+#!/usr/bin/python
+
+import struct
+import zlib
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+# BGZF (blocked gzip) writer and tabix index builder.
+#
+# A BGZF file is a series of gzip members, each holding at most BLOCK_SIZE bytes of input.  Any gzip
+# reader can decompress it, and because every block starts at a known compressed offset, a reader
+# holding a "virtual offset" (compressed block offset << 16 | offset within the block) can seek
+# directly to a record.  The tabix (.tbi) index maps genomic regions to virtual offsets.
+#
+# See the SAM/BAM specification (BGZF section) and the tabix specification for the formats.
+
+BLOCK_SIZE = 0xff00  # max uncompressed bytes per block, as used by bgzip
+
+# 28 byte empty block that terminates every BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+TABIX_FORMAT_VCF = 2
+TABIX_MIN_SHIFT = 14
+TABIX_LEVELS = 5
+TABIX_PSEUDO_BIN = 37450  # ((1 << 18) - 1) // 7 + 1, holds per-reference metadata
+
+
+def compress_block(data, level=6):
+    """
+    Compress one block of at most BLOCK_SIZE bytes into a complete BGZF member.
+    zlib releases the GIL while compressing, so blocks can be compressed on several threads.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = 18 + len(cdata) + 8
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, bsize - 1)
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + trailer
+
+
+class BgzfWriter:
+    """
+    Writes BGZF to a binary file object, compressing blocks on a thread pool.  Blocks are written
+    in order, and the compressed offset of every block is recorded so that uncompressed offsets
+    can be turned into virtual offsets (see virtual_offset) once the file is closed.
+    """
+
+    def __init__(self, fileobj, threads=1, level=6):
+        self._fileobj = fileobj
+        self._level = level
+        self._threads = max(1, threads)
+        self._executor = ThreadPoolExecutor(self._threads) if self._threads > 1 else None
+        self._pending = []            # futures for compressed blocks, in file order
+        self._buffer = bytearray()
+        self._uncompressed_offset = 0
+        self._compressed_offset = 0
+        self._block_offsets = []      # compressed offset of each block, plus the offset of the EOF block
+
+    def tell(self):
+        """
+        :return: the uncompressed offset of the next byte to be written
+        """
+        return self._uncompressed_offset
+
+    def write(self, data):
+        self._buffer += data
+        self._uncompressed_offset += len(data)
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._drain(0)
+        if self._executor:
+            self._executor.shutdown()
+        self._block_offsets.append(self._compressed_offset)
+        self._fileobj.write(EOF_BLOCK)
+
+    def virtual_offset(self, uncompressed_offset):
+        """
+        :return: the BGZF virtual offset of an uncompressed offset.  Only valid after close()
+        """
+        block = uncompressed_offset // BLOCK_SIZE
+        return (self._block_offsets[block] << 16) | (uncompressed_offset % BLOCK_SIZE)
+
+    def _submit(self, block):
+        if self._executor:
+            self._pending.append(self._executor.submit(compress_block, block, self._level))
+            # bound the number of blocks held in memory
+            self._drain(self._threads * 4)
+        else:
+            self._write_block(compress_block(block, self._level))
+
+    def _drain(self, keep):
+        while len(self._pending) > keep:
+            self._write_block(self._pending.pop(0).result())
+
+    def _write_block(self, compressed):
+        self._block_offsets.append(self._compressed_offset)
+        self._fileobj.write(compressed)
+        self._compressed_offset += len(compressed)
+
+
+def reg2bin(beg, end):
+    """
+    UCSC binning scheme, as used by tabix: the smallest bin holding the 0-based, half open interval
+    """
+    end -= 1
+    if beg >> 14 == end >> 14: return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17: return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20: return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23: return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26: return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+class TabixIndex:
+    """
+    Accumulates a tabix index for a VCF, in uncompressed offsets.  Records must be added in file
+    order, and the file must be sorted by chromosome (contiguous) and position.
+    """
+
+    def __init__(self):
+        self._names = []
+        self._refs = []
+        self._seen = set()
+        self._last_beg = 0
+
+    def add(self, chrom, beg, end, start_offset, end_offset):
+        """
+        :param chrom: the record's chromosome
+        :param beg: 0-based start of the record
+        :param end: 0-based, exclusive end of the record
+        :param start_offset: uncompressed offset of the record's first byte
+        :param end_offset: uncompressed offset just past the record
+        """
+        if not self._names or self._names[-1] != chrom:
+            if chrom in self._seen:
+                raise ValueError("chromosome '" + chrom + "' is not contiguous (the file must be sorted)")
+            self._seen.add(chrom)
+            self._names.append(chrom)
+            self._refs.append({"bins": {}, "linear": [], "first": start_offset, "last": end_offset, "count": 0})
+            self._last_beg = 0
+        elif beg < self._last_beg:
+            raise ValueError("position " + str(beg + 1) + " on '" + chrom + "' is out of order (the file must be sorted)")
+        self._last_beg = beg
+
+        ref = self._refs[-1]
+        ref["last"] = end_offset
+        ref["count"] += 1
+
+        chunks = ref["bins"].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        linear = ref["linear"]
+        last_window = (end - 1) >> TABIX_MIN_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> TABIX_MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+    def write(self, fileobj, virtual_offset):
+        """
+        Write the index, BGZF compressed, converting offsets with the data file's virtual_offset function
+        """
+        names = b"".join(name.encode() + b"\0" for name in self._names)
+        out = [b"TBI\1", struct.pack("<8i", len(self._names), TABIX_FORMAT_VCF, 1, 2, 0, ord('#'), 0, len(names)), names]
+        for ref in self._refs:
+            out.append(struct.pack("<i", len(ref["bins"]) + 1))
+            for bin_number, chunks in ref["bins"].items():
+                out.append(struct.pack("<Ii", bin_number, len(chunks)))
+                for (start, end) in chunks:
+                    out.append(struct.pack("<QQ", virtual_offset(start), virtual_offset(end)))
+            out.append(struct.pack("<IiQQQQ", TABIX_PSEUDO_BIN, 2, virtual_offset(ref["first"]),
+                                   virtual_offset(ref["last"]), ref["count"], 0))
+
+            # empty windows inherit the offset of the previous window
+            linear = []
+            previous = 0
+            for offset in ref["linear"]:
+                previous = virtual_offset(offset) if offset is not None else previous
+                linear.append(previous)
+            out.append(struct.pack("<i", len(linear)))
+            out.append(struct.pack("<%dQ" % len(linear), *linear))
+        out.append(struct.pack("<Q", 0))  # no records without coordinates
+
+        writer = BgzfWriter(fileobj)
+        writer.write(b"".join(out))
+        writer.close()
+
+
+def vcf_record_interval(fields):
+    """
+    :return: the 0-based, half open interval covered by a split VCF data line.  The end is the end
+    of REF, or INFO END= when that is larger (symbolic alleles), as computed by tabix.
+    """
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    if len(fields) > 7:
+        for info in fields[7].split(b";"):
+            if info.startswith(b"END="):
+                try:
+                    info_end = int(info[4:])
+                except ValueError:
+                    break
+                if info_end > beg:
+                    end = info_end
+                break
+    return beg, max(end, beg + 1)
+
+
+def open_vcf(path):
+    """
+    Open a VCF for binary reading, decompressing it if it is gzip (or BGZF) compressed
+    """
+    with open(path, "rb") as probe:
+        magic = probe.read(2)
+    return gzip.open(path, "rb") if magic == b"\x1f\x8b" else open(path, "rb")
+
+
+def compress_and_index_vcf(vcf_path, bgzf_path, index_path, threads=1, line_handler=None):
+    """
+    Read a VCF once, writing it as BGZF and building its tabix index in the same pass.
+    :param line_handler: optional function called with each (bytes) line before it is written
+    :raise ValueError: if the VCF is malformed or not sorted, and so cannot be indexed
+    """
+    index = TabixIndex()
+    with open_vcf(vcf_path) as vcf, open(bgzf_path, "wb") as out:
+        writer = BgzfWriter(out, threads)
+        line_number = 0
+        for line in vcf:
+            line_number += 1
+            if line_handler:
+                line_handler(line)
+            start = writer.tell()
+            writer.write(line)
+            if line.startswith(b"#") or not line.strip():
+                continue
+            fields = line.rstrip(b"\r\n").split(b"\t", 8)
+            try:
+                beg, end = vcf_record_interval(fields)
+            except (IndexError, ValueError):
+                raise ValueError("line " + str(line_number) + " is not a valid VCF data line")
+            try:
+                index.add(fields[0].decode(), beg, end, start, writer.tell())
+            except ValueError as e:
+                raise ValueError("line " + str(line_number) + ": " + str(e))
+        writer.close()
+
+    with open(index_path, "wb") as out:
+        index.write(out, writer.virtual_offset)
@@ -88,6 +88,9 @@ OUTPUT
         # for testing
         # sys.exit(1)
 
+    def shardable(self):
+        return True
+
     def identify_dependencies(self):
         """
         The appropriate dependency(ies) will be determined by the reference genome selected - only one for now
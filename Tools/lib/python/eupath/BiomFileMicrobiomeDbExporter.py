@@ -1,68 +1,120 @@
 #!/usr/bin/python
 
 from . import EupathExporter
-import biom
-from biom.cli.table_validator import _validate_table
-from biom.parse import load_table
-class BiomExport(EupathExporter.Export):
+import os
+import re
+import shutil
+import sys
+# biom (and the numpy, scipy and h5py it loads) is imported where it is used, not on loading the exporter
+
+
+class BiomExporter(EupathExporter.Exporter):
+    """
+INPUT
+    type specific args:
+      one or more tuples of: [filepath, filename]
+
+OUTPUT
+  for each BIOM file, converted for MicrobiomeDB:
+     uploaded.biom (the file as given), metadata.json (the table without its data) and data.tsv
+     (the non-zero cells, as observation index, sample index, value)
+  with one file, these are at the top of the tarball.  with several, each file's are in a directory
+  named for the file (cleaned of icky characters)
+
+  the files are converted concurrently, on the job's Galaxy slots, largest first, so a collection
+  takes about as long as its largest table
+
+  the converted files are several times the size of the input (data.tsv has a line per non-zero cell,
+  which a BIOM 2 (HDF5) file holds compressed), so the scratch space reserved for them is a multiple of
+  the input's, by format: (optional) config.json keys biom-json-staging-multiple (default 4) and
+  biom-hdf5-staging-multiple (default 12)
+    """
+
+    # Constants
+    TYPE = "BIOM"
+    VERSION = "1.0, 2.0, or 2.1"
+    GENERATED_BY = "MicrobiomeDb exporter"
+    HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+    DEFAULT_JSON_STAGING_MULTIPLE = 4
+    DEFAULT_HDF5_STAGING_MULTIPLE = 12
+
+    def initialize(self, stdArgsBundle, typeSpecificArgsList):
+
+        super().initialize(stdArgsBundle, BiomExporter.TYPE, BiomExporter.VERSION)
+
+        if len(typeSpecificArgsList) < 2:
+            print("The tool was passed an insufficient numbers of arguments.", file=sys.stderr)
+            exit(1)
+
+        if len(typeSpecificArgsList) % 2 != 0:
+            print("Invalid number of arguments.  Must be one or more 2-tuples.", file=sys.stderr)
+            exit(1)
+
+        self._datasetInfos = []
+        for i in range(0, len(typeSpecificArgsList), 2):   # increment by tuple size (2)
+            self._datasetInfos.append({"name": typeSpecificArgsList[i+1], "path": typeSpecificArgsList[i+0]})
 
-    BIOM_TYPE = "BIOM"
-    BIOM_VERSION = "1.0, 2.0, or 2.1"
-
-    def __init__(self, args):
-        """
-        Initializes the gene list export class with the parameters needed to accomplish the particular
-        type of export.
-        :param args: parameters provided from tool form
-        """
-        EupathExporter.Export.__init__(self,
-                                       BiomExport.BIOM_TYPE,
-                                       BiomExport.BIOM_VERSION,
-                                       None,
-                                       args)
-
-        # generic 7 arguments and then dataset file path
-        if len(args) < 8:
-            raise EupathExporter.ValidationException("The tool was passed an insufficient numbers of arguments:", args)
-
-        self._dataset_file_path = args[7]
-
-
-    def validate_datasets(self):
-        # try read a file
-# gives stupid errors like "Invalid format 'Biological Observation Matrix 0.9.1-dev', must be '1.0.0'"
-#        valid, report = _validate_table(self._dataset_file_path)
-#        if not valid:
-#          raise EupathExporter.ValidationException(report)
-        try:        
-          table=load_table(self._dataset_file_path)
-        except ValueError, e:
-            raise EupathExporter.ValidationException("Could not load the file as BIOM - does it conform to the specification on https://biom-format.org?", e)
-
-        give_table_extra_methods(table)
-        generated_by="MicrobiomeDb exporter"
-
-        with open(self._dataset_file_path+".metadata.json", 'w') as f1:
-          table.to_json_but_only_metadata(generated_by, direct_io=f1)
-
-        with open(self._dataset_file_path+".data.tsv", 'w') as f2:
-          table.to_json_but_only_data_and_not_json_but_tsv(generated_by, direct_io=f2)
-          
     def identify_dependencies(self):
         return []
 
     def identify_projects(self):
         return ["MicrobiomeDB"]
 
-    def identify_supported_projects(self):
-        return ["MicrobiomeDB"]
-
     def identify_dataset_files(self):
-        return [
-          {"name": "uploaded.biom", "path": self._dataset_file_path},
-          {"name": "metadata.json", "path": self._dataset_file_path+".metadata.json"},
-          {"name": "data.tsv", "path": self._dataset_file_path + ".data.tsv"}
-        ]
+        """
+        :return: A list containing the dataset files accompanied by their VEuPathDB designation.
+        """
+        return self._datasetInfos
+
+    def staged_files_size(self):
+        """
+        The copy, metadata.json and data.tsv of each file, estimated as a multiple of its size by its format
+        """
+        json_multiple = float(self._config.get("biom-json-staging-multiple", BiomExporter.DEFAULT_JSON_STAGING_MULTIPLE))
+        hdf5_multiple = float(self._config.get("biom-hdf5-staging-multiple", BiomExporter.DEFAULT_HDF5_STAGING_MULTIPLE))
+        size = 0
+        for dataset_file in self.identify_dataset_files():
+            with open(dataset_file['path'], "rb") as f:
+                hdf5 = f.read(len(BiomExporter.HDF5_SIGNATURE)) == BiomExporter.HDF5_SIGNATURE
+            size += int(os.path.getsize(dataset_file['path']) * (hdf5_multiple if hdf5 else json_multiple))
+        return size
+
+    def prepare_data_files(self, temp_path):
+        """
+        Convert each BIOM file into the temporary dir, in a process pool
+        """
+        conversions = []
+        directories = set()
+        for dataset_file in self.identify_dataset_files():
+            output_dir = temp_path
+            if len(self.identify_dataset_files()) > 1:
+                name = re.sub(r"\.biom$", "", self.clean_file_name(dataset_file['name']))
+                unique_name = name
+                n = 1
+                while unique_name in directories:
+                    n += 1
+                    unique_name = "%s_%d" % (name, n)
+                directories.add(unique_name)
+                output_dir = temp_path + "/" + unique_name
+            conversions.append((os.path.getsize(dataset_file['path']), dataset_file['name'], dataset_file['path'], output_dir))
+        conversions.sort(key=lambda conversion: conversion[0], reverse=True)
+
+        processes = min(len(conversions), EupathExporter.get_galaxy_slots())
+        try:
+            if processes <= 1:
+                for (size, name, path, output_dir) in conversions:
+                    convert_biom_file(name, path, output_dir)
+                    self._progress.advance(size)
+                return
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(processes) as pool:
+                futures = dict((pool.submit(convert_biom_file, name, path, output_dir), size) for (size, name, path, output_dir) in conversions)
+                for future in as_completed(futures):
+                    future.result()
+                    self._progress.advance(futures[future])
+        except BiomConversionException as e:
+            print(str(e), file=sys.stderr)
+            exit(1)
 
     def output_success(self):
         header = "<html><body><h1>Good news!</h1><br />"
@@ -74,10 +126,40 @@ class BiomExport(EupathExporter.Export):
         </h3><br />
         </body></html>
         """
-        with open(self._output, 'w') as file:
+        with open(self._stdArgsBundle.output, 'w') as file:
             file.write("%s%s" % (header,msg))
 
 
+class BiomConversionException(Exception):
+    """
+    A BIOM file could not be converted.
+    """
+    pass
+
+
+def convert_biom_file(name, path, output_dir):
+    """
+    Write a BIOM file's uploaded.biom, metadata.json and data.tsv into a directory.  Run in the
+    exporter's process pool, so it only takes picklable arguments.
+    :param name: the file's name, for error messages
+    """
+    from biom.parse import load_table
+# gives stupid errors like "Invalid format 'Biological Observation Matrix 0.9.1-dev', must be '1.0.0'"
+#    from biom.cli.table_validator import _validate_table
+#    valid, report = _validate_table(path)
+    try:
+        table = load_table(path)
+    except (ValueError, TypeError, KeyError) as e:
+        raise BiomConversionException("Could not load the file " + name + " as BIOM - does it conform to the specification on https://biom-format.org? " + str(e))
+
+    os.makedirs(output_dir, exist_ok=True)
+    shutil.copy(path, output_dir + "/uploaded.biom")
+    give_table_extra_methods(table)
+    with open(output_dir + "/metadata.json", 'w') as f1:
+        table.to_json_but_only_metadata(BiomExporter.GENERATED_BY, direct_io=f1)
+    with open(output_dir + "/data.tsv", 'w') as f2:
+        table.to_json_but_only_data_and_not_json_but_tsv(BiomExporter.GENERATED_BY, direct_io=f2)
+
 
 def give_table_extra_methods(table):
 # just my looking at the name you know this is gonna be good isn't it
@@ -96,7 +178,8 @@ def give_table_extra_methods(table):
 #
 #   Here are the globals
 #
-    from future.utils import string_types
+    from biom.exception import TableException
+    string_types = str
     def get_biom_format_version_string(version=None):
         """Returns the current Biom file format version.
         Parameters
@@ -223,6 +306,7 @@ def give_table_extra_methods(table):
                 rows.append(u'{"id": %s, "metadata": %s}],' % (dumps(obs[1]),
                                                                dumps(obs[2])))
 
+            """
             # turns out its a pain to figure out when to place commas. the
             # simple work around, at the expense of a little memory
             # (bound by the number of samples) is to build of what will be
@@ -232,7 +316,6 @@ def give_table_extra_methods(table):
                 if float(val) != 0.0:
                     built_row.append(u"[%d,%d,%r]" % (obs_index, col_index,
                                                       val))
-            """
             if built_row:
                 # if we have written a row already, its safe to add a comma
                 if have_written:
@@ -400,8 +483,9 @@ def give_table_extra_methods(table):
             for col_index, val in enumerate(obs[0]):
                 if float(val) != 0.0:
                     if direct_io:
-                        direct_io.write(u"%d\t%d\t%r\n" % (obs_index, col_index,
-                                                      val))
+                        # repr of a Python float, as %r of a numpy float was in Python 2
+                        direct_io.write(u"%d\t%d\t%s\n" % (obs_index, col_index,
+                                                      repr(float(val))))
                     else:
                         data.append([obs_index, col_index, val])
             """
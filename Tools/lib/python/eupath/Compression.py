@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+
+# Adaptive gzip compression of the export tarball.
+#
+# The tarball is compressed, then uploaded, so an export takes (input / compression speed) +
+# (compressed size / upload bandwidth).  Higher gzip levels shrink the upload but slow the
+# compression, and which level is fastest end to end depends on the node's CPU and its uplink to VDI.
+#
+# The first PROBE_SIZE bytes of the tar stream are compressed at each candidate level, to measure
+# their speed and ratio on this data, and the level is chosen that minimizes the estimated time to
+# compress and upload the rest.  The tarball is then one gzip member at that level: not a series of
+# members that could change level as they go, because some gzip readers (e.g. commons-compress's
+# GzipCompressorInputStream, by default) stop at the end of the first member, and would silently
+# truncate the tarball.
+#
+# The upload bandwidth is estimated from the uploads recorded in a history file shared by the host's
+# exporters (the median of the last HISTORY_SAMPLES), or else the upload-bandwidth-mb-per-second
+# config.json key.  The level chosen and the compression's outcome are logged to stderr.
+#
+# Configured by these (optional) config.json keys:
+#   upload-bandwidth-mb-per-second  assumed uplink bandwidth when there is no history (default 10)
+#   upload-history                  the history file (default /var/tmp/eupath-export-uploads.jsonl)
+
+CHUNK_SIZE = 8 * 1024 * 1024    # how much is compressed at a time (and counted as done)
+PROBE_SIZE = 2 * 1024 * 1024    # how much of the stream the candidate levels are measured on
+CANDIDATE_LEVELS = (1, 3, 6, 9)
+DEFAULT_BANDWIDTH_MB_PER_SECOND = 10.0
+DEFAULT_HISTORY_PATH = "/var/tmp/eupath-export-uploads.jsonl"
+HISTORY_SAMPLES = 20
+HISTORY_MAX_BYTES = 64 * 1024   # the history is trimmed to its latest samples beyond this
+MB = 1024.0 * 1024.0
+
+
+def history_path(config):
+    return config.get("upload-history", DEFAULT_HISTORY_PATH)
+
+
+def read_upload_history(config):
+    """
+    :return: the latest uploads recorded on this host, as dicts of bytes, seconds and level
+    """
+    try:
+        with open(history_path(config)) as history:
+            lines = history.readlines()
+    except OSError:
+        return []
+    uploads = []
+    for line in lines[-HISTORY_SAMPLES:]:
+        try:
+            uploads.append(json.loads(line))
+        except ValueError:
+            continue
+    return uploads
+
+
+def upload_bandwidth(config):
+    """
+    :return: estimated upload bandwidth to VDI, in bytes per second
+    """
+    rates = sorted(upload["bytes"] / upload["seconds"] for upload in read_upload_history(config) if upload.get("seconds", 0) > 0)
+    if rates:
+        return rates[len(rates) // 2]
+    return float(config.get("upload-bandwidth-mb-per-second", DEFAULT_BANDWIDTH_MB_PER_SECOND)) * MB
+
+
+def record_upload(config, uploaded_bytes, seconds, level=None):
+    """
+    Add an upload to the host's history, for the bandwidth estimates of later exports
+    """
+    path = history_path(config)
+    entry = json.dumps({"time": int(time.time()), "bytes": uploaded_bytes, "seconds": round(seconds, 3), "level": level})
+    try:
+        with open(path, "a") as history:
+            history.write(entry + "\n")
+        if os.path.getsize(path) > HISTORY_MAX_BYTES:
+            with open(path) as history:
+                latest = history.readlines()[-HISTORY_SAMPLES:]
+            temp_path = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+            with open(temp_path, "w") as trimmed:
+                trimmed.writelines(latest)
+            os.replace(temp_path, path)
+    except OSError as e:
+        print("Could not record the upload in " + path + ": " + str(e), file=sys.stderr)
+
+
+def compress_member(data, level):
+    """
+    :return: data as a complete gzip member
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class AdaptiveGzipWriter:
+    """
+    A binary file object that gzip compresses what is written to it into another, as one gzip member
+    at the level chosen on its first PROBE_SIZE bytes (see above).  close() does not close the
+    underlying file.
+    """
+
+    def __init__(self, fileobj, bandwidth, chunk_size=CHUNK_SIZE, levels=CANDIDATE_LEVELS, on_chunk=None):
+        """
+        :param bandwidth: the estimated upload bandwidth, in bytes per second
+        :param on_chunk: called with the number of input bytes of each chunk compressed
+        """
+        self._fileobj = fileobj
+        self._bandwidth = bandwidth
+        self._chunk_size = chunk_size
+        self._levels = levels
+        self._buffer = bytearray()
+        self._level = None
+        self._compressor = None
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self._seconds = 0.0
+        self._on_chunk = on_chunk
+
+    def write(self, data):
+        self._buffer += data
+        if self._compressor is None:
+            if len(self._buffer) < PROBE_SIZE:
+                return len(data)
+            probed = self._probe(bytes(self._buffer[:PROBE_SIZE]))
+            # time spent compressing, if not on the output
+            self._seconds += sum(seconds for (member, seconds) in probed.values())
+            self._choose_level(probed, PROBE_SIZE)
+            self._compressor = zlib.compressobj(self._level, zlib.DEFLATED, 31)
+        while len(self._buffer) >= self._chunk_size:
+            self._compress_chunk(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def close(self):
+        if self._compressor is None:
+            # all of it was probed: the chosen level's sample is the member
+            chunk = bytes(self._buffer)
+            probed = self._probe(chunk)
+            self._choose_level(probed, len(chunk))
+            (member, seconds) = probed[self._level]
+            self._fileobj.write(member)
+            self._account(len(chunk), len(member), sum(seconds for (member, seconds) in probed.values()))
+        else:
+            if self._buffer:
+                self._compress_chunk(bytes(self._buffer))
+            start = time.perf_counter()
+            tail = self._compressor.flush()
+            self._fileobj.write(tail)
+            self._account(0, len(tail), time.perf_counter() - start)
+        self._buffer = bytearray()
+        print("Compression: %.1f MB to %.1f MB in %.1fs at level %d, for an uplink of %.1f MB/s" % (
+            self.input_bytes / MB, self.output_bytes / MB, self._seconds, self._level, self._bandwidth / MB), file=sys.stderr)
+
+    @property
+    def level(self):
+        """
+        :return: the level compressed at
+        """
+        return self._level
+
+    def _compress_chunk(self, chunk):
+        start = time.perf_counter()
+        compressed = self._compressor.compress(chunk)
+        seconds = time.perf_counter() - start
+        self._fileobj.write(compressed)
+        self._account(len(chunk), len(compressed), seconds)
+
+    def _probe(self, sample):
+        """
+        Measure each candidate level's speed and ratio on a sample of the data
+        :return: {level: (the sample's gzip member, seconds taken)}
+        """
+        probed = {}
+        for level in self._levels:
+            start = time.perf_counter()
+            member = compress_member(sample, level)
+            probed[level] = (member, time.perf_counter() - start)
+        return probed
+
+    def _choose_level(self, probed, sample_bytes):
+        # the same for every byte, so the sample is as good a measure of the rest as any
+        sample_bytes = max(sample_bytes, 1)
+        def estimate(level):
+            (member, seconds) = probed[level]
+            return (sample_bytes / max(seconds, 1e-6), len(member) / sample_bytes)
+        def export_seconds(level):
+            speed, ratio = estimate(level)
+            return 1.0 / speed + ratio / self._bandwidth
+        self._level = min(self._levels, key=export_seconds)
+        speed, ratio = estimate(self._level)
+        print("Compression: level %d (estimated %.1f MB/s at ratio %.2f, uplink %.1f MB/s)" % (
+            self._level, speed / MB, ratio, self._bandwidth / MB), file=sys.stderr)
+
+    def _account(self, input_bytes, output_bytes, seconds):
+        self.input_bytes += input_bytes
+        self.output_bytes += output_bytes
+        self._seconds += seconds
+        if self._on_chunk and input_bytes:
+            self._on_chunk(input_bytes)
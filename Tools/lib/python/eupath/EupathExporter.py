@@ -1,19 +1,17 @@
 #!/usr/bin/python
 
+import copy
 import json
-import tarfile
 import time
 import os
-import shutil
 import sys
-import time
-import requests
-import tempfile
 import contextlib
 import re
-import optparse
-from urllib import request, parse
-from urllib.error import HTTPError
+from . import Admission
+from . import Compression
+from . import Profiling
+from . import Progress
+from . import Scratch
 
 
 # Superclass for all exporters
@@ -22,6 +20,10 @@ from urllib.error import HTTPError
 
 # we always authenticate through the eupath dev gateway, even for prod, because it is needed for dev and ok for prod
 
+# requests, urllib.request, tarfile and optparse are imported where they are used, not here: loading
+# them (and their own imports) is a large share of a small export's runtime, and the modules that
+# only need this one's helpers (e.g. ReferenceGenome) shouldn't pay for them.  See bench/bench_startup.py
+
 def print_debug(msg):
     if os.getenv('DEBUG'):
         print(msg,  file=sys.stderr)
@@ -31,19 +33,27 @@ def get_ssl_verify():
         return False
     else:
         return True    
+
+# number of cores Galaxy allotted to this job
+def get_galaxy_slots():
+    return int(os.getenv('GALAXY_SLOTS', os.cpu_count() or 1))
     
 def execute(exporter):
+    import optparse
     (options, args) = optparse.OptionParser().parse_args()
     stdArgsBundle = StandardArgsBundle(args)
     typeSpecificArgsList = stdArgsBundle.getTypeSpecificArgsList(args)
-    exporter.initialize(stdArgsBundle, typeSpecificArgsList);
 
-    try:
-        print_debug("Attempting export.")
-        exporter.export()
-    except SystemException as ve:
-        print(str(ve), file=sys.stderr)
-        sys.exit(1)
+    # opt-in profiling (see Profiling), reported beside the job's output
+    with Profiling.profiled(type(exporter).__name__, stdArgsBundle.output):
+        exporter.initialize(stdArgsBundle, typeSpecificArgsList);
+
+        try:
+            print_debug("Attempting export.")
+            exporter.export()
+        except SystemException as ve:
+            print(str(ve), file=sys.stderr)
+            sys.exit(1)
 
 # A small class capturing the standard args provided by galaxy        
 class StandardArgsBundle:
@@ -68,6 +78,7 @@ class Exporter:
     POLLING_INTERVAL_MAX = 60
     POLLING_TIMEOUT = 10 * POLLING_INTERVAL_MAX 
     SOURCE_GALAXY = "galaxy" # indicate to the service that Galaxy is the point of origin for this user dataset.
+    DEFAULT_MAX_SHARDS = 16
 
     def initialize(self, stdArgsBundle, dataset_type, dataset_version):
         self._stdArgsBundle = stdArgsBundle
@@ -77,6 +88,11 @@ class Exporter:
         # read in config info
         (vdi_service_url, self._vdi_auth_token, self._gateway_url, self._gateway_username, self._gateway_password) = self.read_config()
 
+        # host wide caps on concurrent compressions and uploads (see Admission)
+        self._admission = Admission.AdmissionController.from_config(self._config, self._stdArgsBundle.user_id)
+        self._scratch = Scratch.ScratchManager.from_config(self._config)
+        self._progress = Progress.ProgressReporter.from_config(self._config, self._stdArgsBundle.output)
+
         self._vdi_datasets_url = vdi_service_url + "/vdi-datasets"
 
         gateway_cookie = self.get_eupath_gateway_cookie()
@@ -100,44 +116,185 @@ class Exporter:
         required_config = ["vdi-service-url", "vdi-auth-token", "gateway-url", "gateway-username", "gateway-password"]
         with open(config_path, "r") as config_file:
             config_json = json.load(config_file)
+            self._config = config_json
             missing_elements = set(required_config) - set(config_json.keys())
             if missing_elements:
                 raise SystemException(f"The config file is missing: {missing_elements}")
             return (config_json["vdi-service-url"], config_json["vdi-auth-token"], config_json["gateway-url"], config_json["gateway-username"], config_json["gateway-password"])
                     
     def export(self):
+        shards = self.plan_shards()
+        if len(shards) > 1:
+            self.export_shards(shards)
+            return
 
-        # Save the current working directory so we can get back to it
-        orig_path = os.getcwd()
+        user_dataset_id = self.upload_dataset()
+        self.poll_for_upload_complete(user_dataset_id)   # teriminates if system or validation error
+        print("Export complete. VEuPathDB User Dataset ID: " + user_dataset_id, file=sys.stdout)
 
+    def upload_dataset(self):
+        """
+        Stage, compress and upload the dataset files
+        :return: the VDI dataset ID
+        """
         with self.temporary_directory(self._export_file_root) as temp_path:
-            os.chdir(temp_path)
             print_debug("temp path: " + temp_path)
+            self._progress.begin("staged", self.dataset_files_size())
             self.prepare_data_files(temp_path)
-            tarball_name = self.create_tarball(temp_path)
+            self._progress.end()
+            with self._admission.slot("compress", self.dataset_files_size()):
+                tarball_name = self.create_tarball(temp_path)
             json_body = self.create_body_for_post()
             print_debug(json_body)
-            user_dataset_id = self.post_metadata_and_data(json_body, tarball_name)
+            tarball_size = os.path.getsize(tarball_name)
+            with self._admission.slot("upload", tarball_size):
+                upload_start = time.time()
+                user_dataset_id = self.post_metadata_and_data(json_body, tarball_name)
+                Compression.record_upload(self._config, tarball_size, time.time() - upload_start, self._compression_level)
             print_debug("UD ID: " + user_dataset_id)
-            self.poll_for_upload_complete(user_dataset_id)   # teriminates if system or validation error
-            os.chdir(orig_path) # exit temp dir, prior to removing it
-            print("Export complete. VEuPathDB User Dataset ID: " + user_dataset_id, file=sys.stdout)
-            
+            return user_dataset_id
+
+    # Sharding: when the config.json key shard-bytes is set, an export whose dataset files are bigger
+    # is split into shards of about that size (at most max-shards, default 16), at file boundaries,
+    # if the exporter's files are independent samples (see shardable).  Each shard is exported as its
+    # own VDI dataset, with the same name, type and dependencies and a summary saying which part it
+    # is.  Up to max-parallel-shards (default the Galaxy slots) are staged, compressed and uploaded at
+    # once, and VDI imports them in parallel.
+
+    def shardable(self):
+        """
+        :return: whether the dataset files are independent samples, that could be exported in shards
+        """
+        return False
+
+    def part(self, number, label):
+        """
+        :param number: the part's number, counting from 1
+        :param label: what the part is, to end the dataset's summary with
+        :return: a copy of this exporter, to export a part of the dataset as a dataset of its own
+        """
+        part = copy.copy(self)
+        part._stdArgsBundle = copy.copy(self._stdArgsBundle)
+        part._stdArgsBundle.summary = self._stdArgsBundle.summary + " (" + label + ")"
+        part._export_file_root = self._export_file_root + "_part" + str(number)
+        part._progress = self._progress.part(number, label)
+        part._part_label = label
+        return part
+
+    def shard(self, dataset_files, number, count):
+        """
+        :param dataset_files: the shard's dataset files (see identify_dataset_files)
+        :param number: the shard's number, counting from 1
+        :return: an exporter of just a shard of the dataset files (see part).  Exporters that write
+        more than the dataset files (e.g. a manifest) extend this to cut that down too
+        """
+        shard = self.part(number, "part %d of %d" % (number, count))
+        shard._datasetInfos = dataset_files
+        return shard
+
+    def plan_shards(self):
+        """
+        Balance the dataset files between as many shards as their size calls for: largest first, each
+        to the least full shard
+        :return: the dataset files of each shard, in their original order (one shard if not sharding)
+        """
+        dataset_files = self.identify_dataset_files()
+        shard_bytes = int(self._config.get("shard-bytes", 0))
+        total_bytes = self.dataset_files_size()
+        if not shard_bytes or total_bytes <= shard_bytes or not self.shardable():
+            return [dataset_files]
+
+        count = min(-(-total_bytes // shard_bytes), int(self._config.get("max-shards", self.DEFAULT_MAX_SHARDS)), len(dataset_files))
+        shards = [[0, []] for i in range(count)]   # [bytes, indexes of the dataset files]
+        sizes = [os.path.getsize(dataset_file['path']) for dataset_file in dataset_files]
+        for index in sorted(range(len(dataset_files)), key=lambda index: sizes[index], reverse=True):
+            shard = min(shards, key=lambda shard: shard[0])
+            shard[0] += sizes[index]
+            shard[1].append(index)
+        return [[dataset_files[index] for index in sorted(indexes)] for (size, indexes) in shards]
+
+    def export_shards(self, shards):
+        """
+        Export each shard as its own dataset (see export_parts)
+        """
+        self.export_parts([self.shard(dataset_files, number, len(shards)) for (number, dataset_files) in enumerate(shards, 1)])
+
+    def export_parts(self, parts):
+        """
+        Export parts of the dataset (see part), uploading several at once, and wait for VDI to import
+        each from when its upload ends.  Each part's dataset ID is reported as soon as it is uploaded,
+        and every part is seen through before a failed one fails the export, naming the datasets made.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        def upload(part):
+            start = time.time()
+            user_dataset_id = part.upload_dataset()
+            uploaded = time.time()
+            return (user_dataset_id, uploaded - start, uploaded)
+
+        def confirm_import(part, user_dataset_id, uploaded):
+            part.poll_for_upload_complete(user_dataset_id)
+            return time.time() - uploaded
+
+        def describe(e):
+            # a SystemExit's reason has been printed already
+            return "see above" if isinstance(e, SystemExit) else str(e)
+
+        workers = min(len(parts), int(self._config.get("max-parallel-shards", get_galaxy_slots())))
+        print("Exporting in %d parts, %d at a time" % (len(parts), workers), file=sys.stderr)
+        user_dataset_ids = [None] * len(parts)
+        failures = []
+        with ThreadPoolExecutor(workers) as upload_pool, ThreadPoolExecutor(len(parts)) as import_pool:
+            uploads = dict((upload_pool.submit(upload, part), number) for (number, part) in enumerate(parts))
+            imports = {}
+            for future in as_completed(uploads):
+                number = uploads[future]
+                try:
+                    (user_dataset_id, upload_seconds, uploaded) = future.result()
+                except (SystemExit, Exception) as e:
+                    failures.append((number, "%s was not uploaded (%s)" % (parts[number]._part_label, describe(e))))
+                    continue
+                user_dataset_ids[number] = user_dataset_id
+                print("%s: VEuPathDB User Dataset ID %s, staged and uploaded in %.1fs" % (
+                    parts[number]._part_label, user_dataset_id, upload_seconds), file=sys.stdout, flush=True)
+                imports[import_pool.submit(confirm_import, parts[number], user_dataset_id, uploaded)] = number
+            for future in as_completed(imports):
+                number = imports[future]
+                try:
+                    import_seconds = future.result()
+                except (SystemExit, Exception) as e:
+                    failures.append((number, "%s (VEuPathDB User Dataset ID %s) was not imported (%s)" % (
+                        parts[number]._part_label, user_dataset_ids[number], describe(e))))
+                    continue
+                print("%s: VEuPathDB User Dataset ID %s, import confirmed %.1fs after its upload" % (
+                    parts[number]._part_label, user_dataset_ids[number], import_seconds), file=sys.stderr)
+
+        created = [(part._part_label, user_dataset_id) for (part, user_dataset_id) in zip(parts, user_dataset_ids) if user_dataset_id]
+        if failures:
+            message = "Export failed: " + "; ".join(failure for (number, failure) in sorted(failures)) + "."
+            if created:
+                message += "  The parts uploaded are in My Data Sets, and can be deleted there: " + ", ".join(
+                    "%s as VEuPathDB User Dataset ID %s" % part for part in created)
+            raise SystemException(message)
+        print("Export complete. VEuPathDB User Dataset IDs: " + ", ".join(user_dataset_id for (label, user_dataset_id) in created), file=sys.stdout)
+
     @contextlib.contextmanager
     def temporary_directory(self, dir_name):
         """
-        This method creates a temporary directory such that removal is assured once the
-        program completes.
+        This method creates a temporary directory, on a scratch root with room for the dataset files
+        and the tarball (see Scratch), such that removal is assured once the program completes.
         :param dir_name: The name of the temporary directory
         :return: The full path to the temporary directory
         """
-        temp_path = tempfile.mkdtemp(dir_name)
+        # the staged files, and a tarball no bigger than them
+        try:
+            temp_path = self._scratch.reserve(dir_name, 2 * self.staged_files_size())
+        except Scratch.ScratchSpaceError as e:
+            raise SystemException(str(e))
         try:
             yield temp_path
         finally:
-            # Added the boolean arg because cannot remove top level of temp dir structure in
-            # Globus Dev Galaxy instance and it will throw an Exception if the boolean, 'True', is not in place.
-            shutil.rmtree(temp_path, True)
+            self._scratch.release(temp_path)
 
     def prepare_data_files(self, temp_path):
         """
@@ -147,7 +304,20 @@ class Exporter:
         for dataset_file in self.identify_dataset_files():
             clean_name = temp_path + "/" + self.clean_file_name(dataset_file['name'])
             print_debug("Creating dataset file: " + clean_name)
-            shutil.copy(dataset_file['path'], clean_name)
+            Progress.copy_file(dataset_file['path'], clean_name, self._progress)
+
+    def dataset_files_size(self):
+        """
+        :return: the total size in bytes of the user's dataset files
+        """
+        return sum(os.path.getsize(dataset_file['path']) for dataset_file in self.identify_dataset_files())
+
+    def staged_files_size(self):
+        """
+        Override where prepare_data_files writes more than it is given (e.g. converting the files)
+        :return: the (estimated) total size in bytes of the files staged into the temporary dir
+        """
+        return self.dataset_files_size()
 
     # replace undesired characters with underscore
     def clean_file_name(self, file_name):
@@ -156,17 +326,30 @@ class Exporter:
         
     def create_tarball(self, temp_path):
         """
-        Package the tarball - contains the user's dataset files
+        Package the tarball - contains the user's dataset files.  It is gzip compressed at the level
+        that makes the quickest export, for this data on this host (see Compression)
         """
-        tarball_name = self._export_file_root + ".tgz"
-        with tarfile.open(tarball_name, "w:gz") as tarball:
-            for filename in os.listdir(temp_path):
-                print_debug("Adding file to tarball: " + filename)
-                tarball.add(filename)
+        import tarfile
+        tarball_name = os.path.join(temp_path, self._export_file_root + ".tgz")
+        self._progress.begin("compressed", sum(os.path.getsize(os.path.join(directory, filename))
+                                               for (directory, subdirectories, filenames) in os.walk(temp_path) for filename in filenames))
+        with open(tarball_name, "wb") as tarball_file:
+            compressor = Compression.AdaptiveGzipWriter(tarball_file, Compression.upload_bandwidth(self._config),
+                                                        on_chunk=self._progress.advance)
+            with tarfile.open(mode="w|", fileobj=compressor) as tarball:
+                # the tarball is written in temp_path too, and a stream doesn't know to skip it
+                for filename in [filename for filename in os.listdir(temp_path) if filename != os.path.basename(tarball_name)]:
+                    print_debug("Adding file to tarball: " + filename)
+                    tarball.add(os.path.join(temp_path, filename), filename)
+            compressor.close()
+        self._compression_level = compressor.level
+        self._progress.end()
         #shutil.copy(tarball_name, "/home/galaxy/steve.tgz")
         return tarball_name       
 
     def get_eupath_gateway_cookie(self):
+        from urllib import request, parse
+        from urllib.error import HTTPError
         params = {    
             "username": self._gateway_username,    
             "password": self._gateway_password,    
@@ -202,11 +385,24 @@ class Exporter:
         }
 
     def post_metadata_and_data(self, json_blob, tarball_name):
+        import requests
         print_debug("POSTING data.  Tarball name: " + tarball_name)
         try:
             url = self._vdi_datasets_url + "/admin/proxy-upload"
-            form_fields = {"file": open(tarball_name, "rb"),  "meta":json.dumps(json_blob)}
-            response = requests.post(url, files=form_fields, headers=self._headers, verify=get_ssl_verify())
+            # the multipart form that requests.post(files={"file": tarball, "meta": json}) makes (byte for
+            # byte, with its random boundary; requests gives the meta string the filename "meta"), read
+            # from disk as it is sent, rather than held in memory, so the bytes uploaded can be counted
+            boundary = os.urandom(16).hex()
+            file_header = "--" + boundary + "\r\nContent-Disposition: form-data; name=\"file\"; filename=\"" + os.path.basename(tarball_name) + "\"\r\n\r\n"
+            meta_field = "\r\n--" + boundary + "\r\nContent-Disposition: form-data; name=\"meta\"; filename=\"meta\"\r\n\r\n" + json.dumps(json_blob) + "\r\n--" + boundary + "--\r\n"
+            body = Progress.ProgressReader([file_header.encode(), tarball_name, meta_field.encode()], self._progress)
+            headers = dict(self._headers, **{"Content-Type": "multipart/form-data; boundary=" + boundary})
+            self._progress.begin("uploaded", len(body))
+            try:
+                response = requests.post(url, data=body, headers=headers, verify=get_ssl_verify())
+            finally:
+                body.close()
+            self._progress.end()
 
             # this is only for dev... includes the secret admin auth token
             # print("URL: " + url + " HEADERS: " + str(self._headers) + " CODE: " + str(response.status_code) + "TEXT: " + response.text, file=sys.stderr)
@@ -229,12 +425,14 @@ class Exporter:
 
     # return True if still in progress; False if success.  Fail and terminate if system or validation error
     def check_upload_in_progress(self, user_dataset_id):
+        import requests
         print_debug("Polling for status")
         try:
             url = self._vdi_datasets_url + "/" + user_dataset_id
             response = requests.get(url, headers=self._headers, verify=get_ssl_verify())
             response.raise_for_status()
             json_blob = response.json()
+            self._progress.import_status(json_blob["status"]["import"])
             if json_blob["status"]["import"] == "complete":
                 return False
             if json_blob["status"]["import"] == "invalid":
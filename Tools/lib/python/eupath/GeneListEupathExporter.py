@@ -1,25 +1,52 @@
 from . import EupathExporter
 from . import ReferenceGenome
 import sys
+import os
+import re
+import time
 
 class GeneListExporter(EupathExporter.Exporter):
+    """
+INPUT
+    type specific args:
+      - user's choice of a representative ref genome key
+      - the gene list's filepath and filename
+      - optionally, 'by_genome': partition the list by the genome of each gene (default 'single')
+
+OUTPUT
+  the gene list, as uploaded, for the representative genome's project.
+
+  by_genome: one gene list per genome of the genes, one ID per line, each exported as its own dataset
+  (concurrently) with that genome's dependency and project, and a summary naming the genome.  A gene's
+  genome is looked up in the gene-list-genomes config.json key, of the form:
+     {"PlasmoDB-68_Pfalciparum3D7_Genome": {"prefixes": ["PF3D7_"], "gene-ids": "/path/to/ids.txt"}, ...}
+  where an ID listed in a genome's gene-ids file (one per line) is that genome's, and otherwise
+  the genome with the longest prefix of the ID is.  Genes of no genome go with the representative one.
+  A gene's ID is the first field of its line (split by whitespace, commas or semicolons), so that
+  further columns (e.g. a product description) are not taken for genes; blank lines and lines starting
+  with # are skipped.
+    """
 
     GENE_LIST_TYPE = "GeneList"
     GENE_LIST_VERSION = "1.0"
     UNSPECIFIED_REF_GENOME_KEY = "?"
+    PARTITION_SINGLE = "single"
+    PARTITION_BY_GENOME = "by_genome"
+    ID_DELIMITERS = re.compile(r"[\s,;]+")
+    UNKNOWN_EXAMPLES = 5    # of the IDs of no genome, how many to name in the log
 
     def initialize(self, stdArgsBundle, typeSpecificArgsList):
 
         super().initialize(stdArgsBundle, GeneListExporter.GENE_LIST_TYPE, GeneListExporter.GENE_LIST_VERSION)
 
         ##  TODO:  make this 2
-        if len(typeSpecificArgsList) != 3: 
+        if len(typeSpecificArgsList) not in (3, 4):
             print("The tool was passed an insufficient numbers of arguments.", file=sys.stderr)
             exit(1)
 
         # Override the dataset genome reference with that provided via the form.
         # (We need a ref genome in order to decide which project the gene list is for.  BUT... a gene list might
-        # contain genes from mulitple genomes)
+        # contain genes from mulitple genomes.  The by_genome partition exports each genome's genes for its own)
         refGenomeKey = typeSpecificArgsList[0]
         if len(refGenomeKey.strip()) == 0 or refGenomeKey == GeneListExporter.UNSPECIFIED_REF_GENOME_KEY:
             print("Please select a reference genome from the provided list.", file=sys.stderr)
@@ -28,6 +55,68 @@ class GeneListExporter(EupathExporter.Exporter):
         self._dataset_file_path = typeSpecificArgsList[1]
         self._dataset_file_name = typeSpecificArgsList[2]
 
+        self._partition = GeneListExporter.PARTITION_SINGLE
+        if len(typeSpecificArgsList) == 4:
+            self._partition = typeSpecificArgsList[3]
+        if self._partition not in (GeneListExporter.PARTITION_SINGLE, GeneListExporter.PARTITION_BY_GENOME):
+            print("Unknown gene list partition: " + self._partition, file=sys.stderr)
+            exit(1)
+
+    def export(self):
+        if self._partition == GeneListExporter.PARTITION_SINGLE:
+            super().export()
+            return
+
+        lookup = GenomeLookup.from_config(self._config)
+        with self.temporary_directory(self._export_file_root + "_partitions") as partition_path:
+            start = time.time()
+            (partitions, unknown) = self.partition_by_genome(lookup, partition_path)
+            print("Partitioned the gene list by genome in %.1fs: %s" % (time.time() - start, "; ".join(
+                "%s %d genes" % (genome.identifier, genes) for (genome, path, genes) in partitions)), file=sys.stderr)
+            if unknown:
+                print("%d gene IDs matched no genome, and went with %s (e.g. %s)" % (
+                    unknown[0], self._genome.identifier, ", ".join(unknown[1])), file=sys.stderr)
+            parts = []
+            for number, (genome, path, genes) in enumerate(partitions, 1):
+                part = self.part(number, genome.display_name)
+                part._genome = genome
+                part._dataset_file_path = path
+                parts.append(part)
+            self.export_parts(parts)
+
+    def partition_by_genome(self, lookup, partition_path):
+        """
+        Read the gene list once, writing each genome's genes to a file of their own, one ID per line
+        :return: ([(genome, the file's path, the number of genes)] in order of the genomes' first genes,
+        None or (the number of IDs of no genome, the first few of them))
+        """
+        partitions = {}     # genome key: [genome, path, the open file, genes]
+        unknown = [0, []]
+        with open(self._dataset_file_path) as gene_list:
+            for line in gene_list:
+                gene_id = GeneListExporter.ID_DELIMITERS.split(line.strip(" \t\r\n,;"), 1)[0]
+                if not gene_id or gene_id.startswith("#"):
+                    continue
+                genome_key = lookup.genome_of(gene_id)
+                if genome_key is None:
+                    genome_key = self._genome.identifier
+                    unknown[0] += 1
+                    if len(unknown[1]) < GeneListExporter.UNKNOWN_EXAMPLES:
+                        unknown[1].append(gene_id)
+                partition = partitions.get(genome_key)
+                if partition is None:
+                    genome = self._genome if genome_key == self._genome.identifier else lookup.genome(genome_key)
+                    path = os.path.join(partition_path, "genes%d.txt" % (len(partitions) + 1))
+                    partition = partitions[genome_key] = [genome, path, open(path, "w"), 0]
+                partition[2].write(gene_id + "\n")
+                partition[3] += 1
+        for partition in partitions.values():
+            partition[2].close()
+        if not partitions:
+            print("The gene list has no gene IDs.", file=sys.stderr)
+            exit(1)
+        return ([(genome, path, genes) for (genome, path, out, genes) in partitions.values()], unknown if unknown[0] else None)
+
     def identify_dependencies(self):
         """
         The appropriate dependency(ies) will be determined by the reference genome selected - only one for now
@@ -57,3 +146,59 @@ class GeneListExporter(EupathExporter.Exporter):
         :return: A list containing the single dataset file accompanied by its EuPathDB designation.
         """
         return [{"name": self._dataset_file_name, "path": self._dataset_file_path}]
+
+
+class GenomeLookup:
+    """
+    Finds the genome of a gene ID: from per-genome lists of IDs, or else by the longest genome ID prefix
+    that it starts with (see GeneListExporter's gene-list-genomes)
+    """
+
+    def __init__(self, prefixes, gene_ids):
+        """
+        :param prefixes: {ID prefix: genome key}
+        :param gene_ids: {gene ID: genome key}
+        """
+        self._gene_ids = gene_ids
+        self._genomes = {}
+        # prefixes grouped by length, longest first, so an ID is checked once per length
+        self._prefixes = []
+        for length in sorted(set(len(prefix) for prefix in prefixes), reverse=True):
+            self._prefixes.append((length, dict((prefix, key) for (prefix, key) in prefixes.items() if len(prefix) == length)))
+
+    @classmethod
+    def from_config(cls, config):
+        prefixes = {}
+        gene_ids = {}
+        for genome_key, lookup in config.get("gene-list-genomes", {}).items():
+            for prefix in lookup.get("prefixes", []):
+                prefixes[prefix] = genome_key
+            if "gene-ids" in lookup:
+                with open(lookup["gene-ids"]) as ids:
+                    for gene_id in ids.read().split():
+                        gene_ids[gene_id] = genome_key
+        return cls(prefixes, gene_ids)
+
+    def genome_of(self, gene_id):
+        """
+        :return: the key of the gene's genome, or None if it isn't known
+        """
+        genome_key = self._gene_ids.get(gene_id)
+        if genome_key is not None:
+            return genome_key
+        for length, prefixes in self._prefixes:
+            genome_key = prefixes.get(gene_id[:length])
+            if genome_key is not None:
+                return genome_key
+        return None
+
+    def genome(self, genome_key):
+        """
+        :return: the ReferenceGenome.Genome of a key
+        """
+        if genome_key not in self._genomes:
+            try:
+                self._genomes[genome_key] = ReferenceGenome.Genome(genome_key)
+            except Exception:
+                raise EupathExporter.SystemException("gene-list-genomes in the config file has an invalid genome: " + genome_key)
+        return self._genomes[genome_key]
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+import hashlib
+import json
+import os
+import struct
+import sys
+import numpy as np
+from . import Normalization
+
+# Compact, memory-mappable index of the gene models in a GFF3 file: gene IDs, summed exon lengths
+# and the transcript to gene map, as used by the TPM and FPKM tools.
+#
+# Indexes are cached in a shared directory, keyed by the GFF's path, size and mtime, so annotations
+# that never change (the built-in all_gff data table) are parsed once rather than on every job.
+#
+# File layout:  MAGIC, a little endian uint32 header length, a JSON header, then 8 byte aligned
+# sections.  The header maps each section name to [dtype, offset, length in bytes].  ID lists are
+# stored newline separated (utf-8).
+
+MAGIC = b"EUPATH-GMI1\n"
+DEFAULT_CACHE_DIR = "/var/tmp/eupath-gene-models"
+
+
+def get_cache_dir():
+    return os.getenv('EUPATH_GENE_MODEL_CACHE', DEFAULT_CACHE_DIR)
+
+
+def cache_path(gff, cache_dir):
+    """
+    :return: the path of the cached index for a GFF, keyed by its path, size and mtime
+    """
+    stat = os.stat(gff)
+    key = "%s\0%d\0%d" % (os.path.abspath(gff), stat.st_size, stat.st_mtime_ns)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".gmi")
+
+
+def write_index(models, index_path):
+    """
+    Write gene models to an index file.  The file is written under a temporary name and renamed
+    into place, so concurrent jobs never see a partial index.
+    """
+    sections = [
+        ("gene_ids", "|u1", "\n".join(models.gene_ids.tolist()).encode()),
+        ("length_bp", "<i8", models.length_bp.astype("<i8").tobytes()),
+        ("length_kb", "<f8", models.length_kb.astype("<f8").tobytes()),
+        ("transcript_ids", "|u1", "\n".join(models.transcript_ids).encode()),
+        ("transcript_genes", "<i8", models.transcript_genes.astype("<i8").tobytes()),
+    ]
+    header = {"genes": len(models), "transcripts": len(models.transcript_ids), "sections": {}}
+    offset = 0
+    for name, dtype, data in sections:
+        header["sections"][name] = [dtype, offset, len(data)]
+        offset += len(data) + (-len(data) % 8)
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b" " * (-(len(MAGIC) + 4 + len(header_bytes)) % 8)
+
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(".tmp", "", os.path.dirname(index_path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+            for name, dtype, data in sections:
+                out.write(data + b"\0" * (-len(data) % 8))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, index_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def read_index(index_path):
+    """
+    Memory-map an index file.
+    :return: GeneModels, whose length arrays are views of the mapped file
+    """
+    data = np.memmap(index_path, dtype=np.uint8, mode="r")
+    if data[:len(MAGIC)].tobytes() != MAGIC:
+        raise ValueError("not a gene model index: " + index_path)
+    (header_length,) = struct.unpack("<I", data[len(MAGIC):len(MAGIC) + 4].tobytes())
+    body = len(MAGIC) + 4 + header_length
+    header = json.loads(data[len(MAGIC) + 4:body].tobytes())
+
+    def section(name):
+        dtype, offset, length = header["sections"][name]
+        return data[body + offset:body + offset + length].view(dtype)
+
+    def ids(name, count):
+        return section(name).tobytes().decode().split("\n") if count else []
+
+    return Normalization.GeneModels(ids("gene_ids", header["genes"]), section("length_bp"), section("length_kb"),
+                                    ids("transcript_ids", header["transcripts"]), section("transcript_genes"))
+
+
+def build_index(gff, cache_dir=None):
+    """
+    Parse a GFF3 and store its index in the cache.
+    :return: (GeneModels, path of the index)
+    """
+    cache_dir = cache_dir or get_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = cache_path(gff, cache_dir)
+    models = Normalization.GeneModels.from_gff(gff)
+    write_index(models, index_path)
+    return models, index_path
+
+
+def load_gene_models(gff, cache_dir=None):
+    """
+    Get the gene models of a GFF3, from the cache if it has an index for this version of the file,
+    otherwise by parsing it and adding it to the cache.  A cache that cannot be written is skipped.
+    """
+    cache_dir = cache_dir or get_cache_dir()
+    try:
+        index_path = cache_path(gff, cache_dir)
+    except OSError:
+        raise SystemExit('File ' + gff + ' could not be opened for reading.\n')
+
+    if os.path.exists(index_path):
+        try:
+            return read_index(index_path)
+        except (ValueError, KeyError, OSError) as e:
+            print("Ignoring unreadable gene model index " + index_path + ": " + str(e), file=sys.stderr)
+
+    models = Normalization.GeneModels.from_gff(gff)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_index(models, index_path)
+    except OSError as e:
+        print("Could not cache gene model index in " + cache_dir + ": " + str(e), file=sys.stderr)
+    return models
@@ -0,0 +1,393 @@
+#!/usr/bin/python
+
+import gzip
+import itertools
+import re
+import numpy as np
+from .EupathExporter import get_galaxy_slots
+
+# Shared engine for the TPM and FPKM tools.
+#
+# Gene models and counts are held in aligned NumPy arrays (one slot per gene, in the order genes first
+# appear in the GFF) and RPK, TPM and FPKM are computed as whole-array operations.  The arithmetic is
+# done in the same order as the original per-gene loops, so output is bit-for-bit identical to them:
+# sums that feed a division are sequential (cumsum), not pairwise.
+
+SPECIAL_COUNTERS = frozenset(['__no_feature', '__ambiguous', '__too_low_aQual', '__not_aligned', '__alignment_not_unique'])
+
+# header lines and special counters of htseq-count files, and the extra IDs of comma separated ID lists
+COUNTS_SKIPPED_LINE = re.compile(r'^(?:#ID.*|(?:' + '|'.join(SPECIAL_COUNTERS) + r')(?:,\S*)?(?=\s).*)(?:\n|$)', re.MULTILINE)
+COUNTS_EXTRA_IDS = re.compile(r',\S*')
+
+GFF_FEATURE_TYPE_COL = 2
+GFF_START_COL = 3
+GFF_END_COL = 4
+GFF_ATTRIBUTE_COL = 8
+
+# the first transcript of each Parent= attribute of an exon
+EXON_PARENT = re.compile(r'(?:^|;)Parent=([^;,]*)')
+
+
+class GeneModels(object):
+    """
+    Genes of a reference annotation, with their summed exon lengths, and a lookup from gene and
+    transcript IDs to the gene's index.
+    :param gene_ids: gene IDs, in the order their first exon appears in the GFF
+    :param length_bp: summed exon length of each gene, in bases
+    :param length_kb: summed exon length of each gene, in kilobases (summed exon by exon, as TPMtool did)
+    :param transcript_ids: IDs of the transcripts that belong to one of the genes
+    :param transcript_genes: index of the gene each of those transcripts belongs to
+    """
+
+    def __init__(self, gene_ids, length_bp, length_kb, transcript_ids, transcript_genes):
+        self.gene_ids = np.array(gene_ids, dtype=object)
+        self.length_bp = np.asarray(length_bp, dtype=np.int64)
+        self.length_kb = np.asarray(length_kb, dtype=np.float64)
+        self.transcript_ids = transcript_ids
+        self.transcript_genes = np.asarray(transcript_genes, dtype=np.int64)
+
+        # gene IDs take precedence over transcript IDs
+        self.lookup = dict(zip(transcript_ids, self.transcript_genes.tolist()))
+        self.lookup.update((gene, i) for i, gene in enumerate(gene_ids))
+
+    def __len__(self):
+        return len(self.gene_ids)
+
+    @classmethod
+    def from_gff(cls, gff):
+        """
+        Parse a GFF3 file in one pass.  Exons are resolved to genes after the pass, so transcripts
+        may appear after their exons.
+        """
+        transcript_parents = {}
+        exon_parents = []
+        exon_lengths = []
+        try:
+            with open(gff) as file:
+                for line in file:
+                    if line.startswith('#'):
+                        continue
+                    fields = line.rstrip('\r\n').split('\t')
+                    if len(fields) <= GFF_ATTRIBUTE_COL:
+                        continue
+                    feature_type = fields[GFF_FEATURE_TYPE_COL]
+
+                    if feature_type.endswith('transcript') or feature_type.endswith('RNA'):
+                        id = None
+                        parent = None
+                        attribute_string = fields[GFF_ATTRIBUTE_COL]
+                        for attr in attribute_string.split(';'):
+                            if attr.startswith('ID='):
+                                id = attr[3:]
+                            if attr.startswith('Parent='):
+                                parent = attr[7:]
+                        if not id:
+                            raise SystemExit('No ID found in transcript attribute string  "' + attribute_string + '"\n')
+                        if not parent:
+                            raise SystemExit('No parent found in transcript attribute string "' + attribute_string + '"\n')
+                        transcript_parents[id] = parent
+
+                    elif feature_type == 'exon':
+                        try:
+                            length = int(fields[GFF_END_COL]) - int(fields[GFF_START_COL]) + 1
+                        except ValueError:
+                            raise SystemExit('Start value ' + fields[GFF_START_COL] + ' or end value ' + fields[GFF_END_COL] + ' could not be converted to a numeric type.\n')
+                        # if we get a comma-separated list of transcripts as parents, use the first one
+                        for parent in EXON_PARENT.findall(fields[GFF_ATTRIBUTE_COL]):
+                            exon_parents.append(parent)
+                            exon_lengths.append(length)
+        except IOError:
+            raise SystemExit('File ' + gff + ' could not be opened for reading.\n')
+
+        return cls.from_exons(exon_parents, exon_lengths, transcript_parents)
+
+    @classmethod
+    def from_exons(cls, exon_parents, exon_lengths, transcript_parents):
+        """
+        :param exon_parents: parent transcript ID of each exon, in file order
+        :param exon_lengths: length of each exon
+        """
+        try:
+            exon_genes = [transcript_parents[transcript] for transcript in exon_parents]
+        except KeyError as e:
+            raise SystemExit('No parent gene found for transcript "' + e.args[0] + '"\n')
+        gene_ids = list(dict.fromkeys(exon_genes))
+        index = {gene: i for i, gene in enumerate(gene_ids)}
+        exon_index = np.fromiter((index[gene] for gene in exon_genes), dtype=np.intp, count=len(exon_genes))
+        lengths = np.array(exon_lengths, dtype=np.int64)
+
+        length_bp = np.zeros(len(gene_ids), dtype=np.int64)
+        np.add.at(length_bp, exon_index, lengths)
+        # ufunc.at adds exon by exon in file order, matching the sequential float sums of the original tools
+        length_kb = np.zeros(len(gene_ids), dtype=np.float64)
+        np.add.at(length_kb, exon_index, lengths / 1000)
+
+        transcripts = [(tx, index[gene]) for tx, gene in transcript_parents.items() if gene in index]
+        return cls(gene_ids, length_bp, length_kb, [tx for (tx, i) in transcripts], [i for (tx, i) in transcripts])
+
+    def gene_index(self, ids):
+        """
+        :return: array of the index of the gene each gene or transcript ID belongs to
+        """
+        lookup = self.lookup
+        try:
+            return np.fromiter((lookup[id] for id in ids), dtype=np.intp, count=len(ids))
+        except KeyError as e:
+            raise SystemExit('ID "' + e.args[0] + '" in counts file not recognized as gene or transcript ID')
+
+
+def open_text(path):
+    """
+    Open a file for reading as text, decompressing it if it is gzip compressed
+    """
+    with open(path, 'rb') as probe:
+        magic = probe.read(2)
+    return gzip.open(path, 'rt') if magic == b'\x1f\x8b' else open(path)
+
+
+def read_counts(input):
+    """
+    Read an htseq-count file (optionally gzip compressed).
+    :return: (ids, counts) in file order, without the special counters.  Comma separated IDs are
+    reduced to their first ID.
+    """
+    try:
+        with open_text(input) as file:
+            text = file.read()
+    except IOError:
+        raise SystemExit('File ' + input + ' could not be opened for reading.\n')
+
+    # Fast path: drop headers and special counters and reduce comma separated IDs with whole-text
+    # regular expressions, then split the whole file at once.  It only applies when every line is an
+    # ID and a count, which is checked by the token count, by the tabs and newlines alternating (one
+    # tab a line: a line of three tokens and one of one would make up the tokens of two) and by the
+    # counts all parsing as integers; anything else falls back to the line by line parser, which also
+    # produces its error messages.
+    body = COUNTS_SKIPPED_LINE.sub('', text) if ('__' in text or '#ID' in text) else text
+    if ',' in body:
+        # if we get a comma-separated list of transcripts as parents, use the first one
+        body = COUNTS_EXTRA_IDS.sub('', body)
+    tokens = body.split()
+    lines = body.count('\n') + (0 if body.endswith('\n') or not body else 1)
+    if len(tokens) == 2 * lines and one_tab_per_line(body, lines):
+        try:
+            return tokens[0::2], np.array(tokens[1::2], dtype=np.int64)
+        except (ValueError, OverflowError):
+            pass
+
+    return parse_counts_lines(text.splitlines(True))
+
+
+def one_tab_per_line(body, lines):
+    """
+    :return: whether each of the lines of the text has exactly one tab
+    """
+    text = np.frombuffer(body.encode(), dtype=np.uint8)
+    separators = text[(text == ord('\t')) | (text == ord('\n'))]
+    return (len(separators) == 2 * lines - (0 if body.endswith('\n') else 1)
+            and (separators[0::2] == ord('\t')).all() and (separators[1::2] == ord('\n')).all())
+
+
+def parse_counts_lines(lines):
+    ids = []
+    counts = []
+    for line in lines:
+        if line.startswith('#ID'):
+            continue
+        fields = line.rstrip().split('\t')
+        if not fields[0]:
+            continue
+        # if we get a comma-separated list of transcripts as parents, use the first one
+        id = fields[0].split(',', 1)[0]
+        if id in SPECIAL_COUNTERS:
+            continue
+        try:
+            counts.append(int(fields[1]))
+        except (ValueError, IndexError):
+            raise SystemExit('Count value for ' + id + ' could not be converted to a numeric type.\n')
+        ids.append(id)
+    return ids, np.array(counts, dtype=np.int64)
+
+
+def read_counts_files(inputs, processes=None):
+    """
+    Read many htseq-count files, spread across a process pool.
+    :param processes: pool size; defaults to the job's Galaxy slots
+    :return: list of (ids, counts), in the order of the inputs
+    """
+    processes = min(len(inputs), processes or get_galaxy_slots())
+    if processes <= 1:
+        return [read_counts(input) for input in inputs]
+    # imported here, as it takes longer to load than a single sample takes to read
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(read_counts, inputs))
+
+
+def first_position_last_value(keys, values):
+    """
+    Collapse repeated keys the way assigning into a dict does: each key keeps the position of its
+    first occurrence and the value of its last.
+    """
+    keys = np.asarray(keys)
+    uniq, first = np.unique(keys, return_index=True)
+    _, last_reversed = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last_reversed
+    by_position = np.argsort(first, kind='stable')
+    return uniq[by_position], values[last[by_position]]
+
+
+def tpm(models, samples):
+    """
+    Compute TPM for one or more count vectors that share a normalization (sense, then antisense).
+    :param samples: list of (ids, counts) as returned by read_counts
+    :return: list of (gene index array, TPM array), one per sample, genes in order of first appearance
+    """
+    rpks = []
+    for ids, counts in samples:
+        # a repeated ID keeps only its last count
+        unique_counts = dict(zip(ids, counts.tolist()))
+        genes = models.gene_index(list(unique_counts))
+        lengths = models.length_kb[genes]
+        if (lengths == 0).any():
+            gene = models.gene_ids[genes[np.argmax(lengths == 0)]]
+            raise SystemExit('Gene length for gene ' + gene + ' is 0. Gene length should not be 0.\n')
+        rpk = np.fromiter(unique_counts.values(), dtype=np.int64, count=len(unique_counts)) / lengths
+        rpks.append((genes, rpk))
+
+    rpk_sum = 0
+    all_rpk = np.concatenate([rpk for (genes, rpk) in rpks])
+    if len(all_rpk):
+        rpk_sum = np.cumsum(all_rpk)[-1]
+    if rpk_sum == 0:
+        raise SystemExit('Sum of Reads Per Kilobase values for all genes is 0. This usually indicates a problem with the count data. Please check your input and try again\n')
+
+    scale = rpk_sum / 1000000
+    results = []
+    for genes, rpk in rpks:
+        # transcripts of the same gene overwrite each other's value
+        genes, rpk = first_position_last_value(genes, rpk)
+        results.append((genes, rpk / scale))
+    return results
+
+
+def fpkm(models, samples):
+    """
+    Compute FPKM for one or more count vectors that share a normalization (sense, then antisense).
+    :param samples: list of (ids, counts) as returned by read_counts
+    :return: list of (gene index array, FPKM array), one per sample, covering every gene in the models
+    """
+    gene_counts = []
+    total = 0
+    for ids, counts in samples:
+        genes = models.gene_index(ids)
+        gene_counts.append(np.bincount(genes, weights=counts, minlength=len(models)))
+        total += int(counts.sum())
+    if total == 0:
+        raise SystemExit('Total of all counts is 0. This usually indicates a problem with the count data. Please check your input and try again\n')
+
+    denominator = total * models.length_bp
+    all_genes = np.arange(len(models))
+    return [(all_genes, (counts * 10 ** 9) / denominator) for counts in gene_counts]
+
+
+def group_by_layout(samples, dedupe):
+    """
+    Group count vectors that list the same IDs in the same order (as htseq-count output for one
+    annotation does), so each group can be normalized as a single IDs x samples matrix.
+    :param dedupe: collapse repeated IDs to their last count, as TPMtool does
+    :return: list of (ids, member sample numbers, IDs x members count matrix)
+    """
+    groups = {}
+    for number, (ids, counts) in enumerate(samples):
+        if dedupe:
+            unique_counts = dict(zip(ids, counts.tolist()))
+            ids = list(unique_counts)
+            counts = np.fromiter(unique_counts.values(), dtype=np.int64, count=len(unique_counts))
+        group = groups.setdefault(tuple(ids), (ids, [], []))
+        group[1].append(number)
+        group[2].append(counts)
+    return [(ids, members, np.column_stack(columns)) for (ids, members, columns) in groups.values()]
+
+
+def tpm_per_sample(models, samples, names):
+    """
+    Compute TPM for many samples, each normalized on its own exactly as a separate TPMtool run would.
+    Samples with the same ID layout are computed together as one matrix.
+    :param samples: list of (ids, counts) as returned by read_counts
+    :param names: sample names, for error messages
+    :return: list of (gene index array, TPM array), one per sample
+    """
+    results = [None] * len(samples)
+    for ids, members, counts in group_by_layout(samples, True):
+        genes = models.gene_index(ids)
+        lengths = models.length_kb[genes]
+        if (lengths == 0).any():
+            gene = models.gene_ids[genes[np.argmax(lengths == 0)]]
+            raise SystemExit('Gene length for gene ' + gene + ' is 0. Gene length should not be 0.\n')
+        rpk = counts / lengths[:, np.newaxis]
+
+        # cumsum runs down each column in order, giving the same sums as the sequential loop
+        rpk_sums = np.cumsum(rpk, axis=0)[-1] if len(rpk) else np.zeros(len(members))
+        for column in np.flatnonzero(rpk_sums == 0):
+            raise SystemExit('Sum of Reads Per Kilobase values for all genes in sample ' + names[members[column]] + ' is 0. This usually indicates a problem with the count data. Please check your input and try again\n')
+        tpm = rpk / (rpk_sums / 1000000)
+
+        # transcripts of the same gene overwrite each other's value
+        unique_genes, rows = first_position_last_value(genes, np.arange(len(genes)))
+        for column, number in enumerate(members):
+            results[number] = (unique_genes, tpm[rows, column])
+    return results
+
+
+def fpkm_per_sample(models, samples, names):
+    """
+    Compute FPKM for many samples, each normalized on its own exactly as a separate FPKMtool run would.
+    Samples with the same ID layout are computed together as one matrix.
+    :param samples: list of (ids, counts) as returned by read_counts
+    :param names: sample names, for error messages
+    :return: list of (gene index array, FPKM array), one per sample, covering every gene in the models
+    """
+    results = [None] * len(samples)
+    all_genes = np.arange(len(models))
+    for ids, members, counts in group_by_layout(samples, False):
+        gene_counts = np.zeros((len(models), len(members)), dtype=np.int64)
+        np.add.at(gene_counts, models.gene_index(ids), counts)
+        totals = counts.sum(axis=0)
+        for column in np.flatnonzero(totals == 0):
+            raise SystemExit('Total of all counts in sample ' + names[members[column]] + ' is 0. This usually indicates a problem with the count data. Please check your input and try again\n')
+        fpkm = (gene_counts.astype(np.float64) * 10 ** 9) / (totals[np.newaxis, :] * models.length_bp[:, np.newaxis])
+        for column, number in enumerate(members):
+            results[number] = (all_genes, fpkm[:, column])
+    return results
+
+
+def write_matrix(path, gene_ids, names, results):
+    """
+    Write a genes x samples matrix, one row per gene in the models and one column per sample.
+    Genes missing from a sample's counts are written as NA.
+    :param results: list of (gene index array, values array) per sample, as from tpm_per_sample
+    """
+    matrix = np.full((len(gene_ids), len(results)), np.nan)
+    for column, (genes, values) in enumerate(results):
+        matrix[genes, column] = values
+    row_format = "%s" + "\t%.12f" * len(results) + "\n"
+    rows = zip(gene_ids, *matrix.T.tolist())
+    body = (row_format * len(gene_ids)) % tuple(itertools.chain.from_iterable(rows))
+    try:
+        with open(path, 'w') as out:
+            out.write('gene_id\t' + '\t'.join(names) + '\n' + body.replace('\tnan', '\tNA'))
+    except IOError:
+        raise SystemExit('Output file ' + path + ' cannot be opened for writing.\n')
+
+
+def write_values(path, column, gene_ids, values):
+    """
+    Write a two column gene_id/value file, formatting every row in one operation and writing it in one call.
+    """
+    body = ("%s\t%.12f\n" * len(values)) % tuple(itertools.chain.from_iterable(zip(gene_ids, values.tolist())))
+    try:
+        with open(path, 'w') as out:
+            out.write('gene_id\t' + column + '\n' + body)
+    except IOError:
+        raise SystemExit('Output file ' + path + ' cannot be opened for writing.\n')
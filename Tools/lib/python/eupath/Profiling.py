@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+import collections
+import cProfile
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Opt-in profiling of the tools' entry points, for finding the hot spots of a slow production job
+# without changing code.
+#
+# Enabled by the EUPATH_PROFILE environment variable, or else the "profile" key of config.json, set
+# to a comma separated list of:
+#   cprofile - deterministic profile of every function call (cProfile).  Exact, but slows pure
+#              Python code down noticeably
+#   sample   - statistical profile: a thread records the main thread's stack every
+#              EUPATH_PROFILE_INTERVAL seconds (default 0.005).  Low overhead: a brief hold of
+#              the GIL per sample
+#   memory   - trace Python allocations (tracemalloc): the peak, and the largest allocation sites
+# Peak resident memory, of the tool and of any child processes, is always reported.
+#
+# The report is written to EUPATH_PROFILE_DIR if set, else beside the job's output file, as
+# <output>.<tool>.<pid>.profile.txt (cprofile mode also writes the raw stats, as .prof).
+#
+# pstats and tracemalloc are only imported when profiling, as this module is imported by every tool.
+
+PROFILE_MODES = ("cprofile", "sample", "memory")
+DEFAULT_SAMPLE_INTERVAL = 0.005
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "config", "config.json")
+
+
+def get_profile_modes():
+    """
+    :return: the set of enabled profile modes, from EUPATH_PROFILE or config.json (empty if not enabled)
+    """
+    setting = os.getenv('EUPATH_PROFILE')
+    if setting is None:
+        try:
+            with open(CONFIG_PATH, "r") as config_file:
+                setting = json.load(config_file).get("profile", "")
+        except (OSError, ValueError):
+            setting = ""
+    modes = set(mode.strip() for mode in setting.split(",") if mode.strip())
+    unknown = modes - set(PROFILE_MODES)
+    if unknown:
+        print("Ignoring unknown profile modes: " + ", ".join(sorted(unknown)), file=sys.stderr)
+    return modes & set(PROFILE_MODES)
+
+
+def option_value(argv, *options):
+    """
+    :return: the value of the first of the given command line options found in argv, or None.  For
+    locating a tool's output before its own argument parsing has run
+    """
+    for option in options:
+        for i, arg in enumerate(argv):
+            if arg == option and i + 1 < len(argv):
+                return argv[i + 1]
+            if arg.startswith(option + "="):
+                return arg[len(option) + 1:]
+    return None
+
+
+def report_path(tool, output_path):
+    directory = os.getenv('EUPATH_PROFILE_DIR')
+    if output_path:
+        prefix = os.path.join(directory or os.path.dirname(os.path.abspath(output_path)), os.path.basename(output_path.rstrip(os.sep)))
+    else:
+        prefix = os.path.join(directory or os.getcwd(), "job")
+    return "%s.%s.%d.profile.txt" % (prefix, tool, os.getpid())
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread at a fixed interval, from a background thread, counting each
+    distinct stack.  The sampled code is slowed by one short hold of the GIL per interval: the
+    sampler's, to walk and record the stack (tens of microseconds for a deep one), which Python code
+    waits out (and code in a call that releases the GIL, e.g. I/O, zlib or numpy, mostly doesn't).
+    """
+
+    def __init__(self, thread_id, interval=DEFAULT_SAMPLE_INTERVAL):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stacks = collections.Counter()
+        self._samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            self._stacks[tuple(reversed(stack))] += 1
+            self._samples += 1
+
+    def report(self, out, limit=40):
+        out.write("Sampled %d stacks, every %gs\n" % (self._samples, self._interval))
+        if not self._samples:
+            return
+        inclusive = collections.Counter()
+        own = collections.Counter()
+        for stack, count in self._stacks.items():
+            for function in set(stack):
+                inclusive[function] += count
+            own[stack[-1]] += count
+
+        out.write("\n%8s %7s  %s\n" % ("samples", "percent", "function, including callees"))
+        for function, count in inclusive.most_common(limit):
+            out.write("%8d %6.1f%%  %s\n" % (count, 100.0 * count / self._samples, function))
+        out.write("\n%8s %7s  %s\n" % ("samples", "percent", "function, own time"))
+        for function, count in own.most_common(limit):
+            out.write("%8d %6.1f%%  %s\n" % (count, 100.0 * count / self._samples, function))
+
+        # collapsed stacks, as read by flamegraph.pl and speedscope
+        out.write("\nCollapsed stacks\n")
+        for stack, count in self._stacks.most_common():
+            out.write("%s %d\n" % (";".join(stack), count))
+
+
+def write_report(path, tool, modes, elapsed, profiler, sampler):
+    import pstats
+    import tracemalloc
+    out = io.StringIO()
+    out.write("%s profile (%s), pid %d\n" % (tool, ",".join(sorted(modes)), os.getpid()))
+    out.write("Command line: %s\n" % " ".join(sys.argv))
+    out.write("Elapsed: %.3fs\n" % elapsed)
+
+    # ru_maxrss is in kilobytes on Linux
+    out.write("Peak resident memory: %.1f MB (largest child process: %.1f MB)\n" % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0))
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        out.write("Peak traced Python allocations: %.1f MB (%.1f MB at exit)\n" % (peak / 1048576.0, current / 1048576.0))
+        out.write("\nLargest allocation sites still held at exit\n")
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:20]:
+            out.write("  %s\n" % stat)
+        tracemalloc.stop()
+
+    if profiler:
+        out.write("\n")
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(60)
+        profiler.dump_stats(path[:-len(".txt")] + ".prof")
+    if sampler:
+        out.write("\n")
+        sampler.report(out)
+
+    with open(path, "w") as report:
+        report.write(out.getvalue())
+    print("Profile written to " + path, file=sys.stderr)
+
+
+@contextmanager
+def profiled(tool, output_path=None):
+    """
+    Profile the enclosed code, if profiling is enabled, writing the report when it finishes
+    (including by sys.exit or an exception).
+    :param tool: name of the tool, used in the report's name
+    :param output_path: the job's output file, beside which the report is written
+    """
+    modes = get_profile_modes()
+    if not modes:
+        yield
+        return
+
+    profiler = cProfile.Profile() if "cprofile" in modes else None
+    sampler = None
+    if "sample" in modes:
+        sampler = StackSampler(threading.get_ident(), float(os.getenv('EUPATH_PROFILE_INTERVAL', DEFAULT_SAMPLE_INTERVAL)))
+    if "memory" in modes:
+        import tracemalloc
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    if sampler:
+        sampler.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        if sampler:
+            sampler.stop()
+        elapsed = time.perf_counter() - start
+        try:
+            write_report(report_path(tool, output_path), tool, modes, elapsed, profiler, sampler)
+        except OSError as e:
+            print("Could not write profile: " + str(e), file=sys.stderr)
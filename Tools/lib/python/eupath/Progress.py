@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+import json
+import os
+import sys
+import time
+
+# Progress of an export, for the Galaxy user (and us) to see that a long one is moving.
+#
+# The exporter counts bytes through its phases: staged (copied or converted into the scratch
+# directory), compressed (into the tarball) and uploaded (to VDI), then follows VDI's import status.
+# The counts are reported, with the time elapsed, as a line on stderr (shown in Galaxy's job
+# information while the job runs) and as a JSON file replaced in place, for anything watching.
+#
+# Counting is cheap: the exporter adds to a counter, and a report is made at most once every
+# interval (except when a phase or the import status changes), so the hot paths aren't slowed.
+#
+# Configured by the EUPATH_PROGRESS_FILE environment variable, or else these (optional)
+# config.json keys:
+#   progress-file              the JSON file (default beside the job's output file, as <output>.progress.json)
+#   progress-interval-seconds  the least time between reports (default 10)
+
+PHASES = ("staged", "compressed", "uploaded")
+DEFAULT_INTERVAL_SECONDS = 10.0
+COPY_BLOCK_SIZE = 64 * 1024 * 1024
+GB = 1024.0 * 1024.0 * 1024.0
+
+
+def format_bytes(count):
+    if count >= GB:
+        return "%.1f GB" % (count / GB)
+    return "%.1f MB" % (count / (1024.0 * 1024.0))
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh%02dm%02ds" % (hours, minutes, seconds)
+    return "%dm%02ds" % (minutes, seconds)
+
+
+class ProgressReporter:
+    """
+    Counts an export's bytes through its phases, and reports them at a bounded rate (see above)
+    """
+
+    def __init__(self, path=None, interval=DEFAULT_INTERVAL_SECONDS, stream=sys.stderr, label=None):
+        """
+        :param path: the JSON file to keep up to date, or None for none
+        :param label: which part of the export the reports are of, if it is in parts
+        """
+        self._path = path
+        self._label = label
+        self._interval = interval
+        self._stream = stream
+        self._start = time.monotonic()
+        self._next_report = self._start + interval
+        self._phase = PHASES[0]
+        self._bytes = dict((phase, 0) for phase in PHASES)
+        self._totals = {}
+        self._import_status = None
+
+    @classmethod
+    def from_config(cls, config, output):
+        """
+        :param output: the job's output file, beside which the progress file goes by default
+        """
+        path = os.getenv("EUPATH_PROGRESS_FILE") or config.get("progress-file", output + ".progress.json")
+        return cls(path, float(config.get("progress-interval-seconds", DEFAULT_INTERVAL_SECONDS)))
+
+    def part(self, number, label):
+        """
+        :return: a reporter of one part of an export in parts, reporting to <path>.part<number>
+        """
+        return ProgressReporter(self._path and self._path + ".part" + str(number), self._interval, self._stream, label)
+
+    def begin(self, phase, total_bytes):
+        """
+        Start a phase, of an expected number of bytes
+        """
+        self._phase = phase
+        self._totals[phase] = total_bytes
+        self.report()
+
+    def advance(self, byte_count):
+        """
+        Count bytes through the current phase
+        """
+        self._bytes[self._phase] += byte_count
+        if time.monotonic() >= self._next_report:
+            self.report()
+
+    def end(self):
+        """
+        End the current phase, whose bytes are then all counted (however many were)
+        """
+        self._bytes[self._phase] = max(self._bytes[self._phase], self._totals.get(self._phase, 0))
+        self.report()
+
+    def import_status(self, status):
+        """
+        Note VDI's import status of the dataset, reporting it if it has changed
+        """
+        if status != self._import_status:
+            self._phase = "importing"
+            self._import_status = status
+            self.report()
+        elif time.monotonic() >= self._next_report:
+            self.report()
+
+    def report(self):
+        now = time.monotonic()
+        self._next_report = now + self._interval
+        elapsed = now - self._start
+        if self._import_status is not None:
+            message = "VDI import " + self._import_status
+        else:
+            done = self._bytes[self._phase]
+            total = self._totals.get(self._phase, 0)
+            message = self._phase + " " + format_bytes(done)
+            if total:
+                message += " of " + format_bytes(total) + " (%d%%)" % min(100, 100 * done // total)
+        if self._label:
+            message = self._label + ": " + message
+        # one write, so the lines of parts reporting from their own threads don't interleave
+        self._stream.write("Progress: " + message + ", " + format_seconds(elapsed) + " elapsed\n")
+        self._stream.flush()
+        if self._path:
+            self._write_file(elapsed)
+
+    def _write_file(self, elapsed):
+        state = {"part": self._label, "phase": self._phase, "elapsed_seconds": round(elapsed, 1), "import_status": self._import_status}
+        for phase in PHASES:
+            state[phase + "_bytes"] = self._bytes[phase]
+            state[phase + "_total_bytes"] = self._totals.get(phase)
+        temp_path = self._path + ".tmp"
+        try:
+            with open(temp_path, "w") as progress_file:
+                json.dump(state, progress_file)
+            os.replace(temp_path, self._path)
+        except OSError as e:
+            print("Could not write the progress file " + self._path + ": " + str(e), file=sys.stderr)
+            self._path = None
+
+
+def copy_file(source, destination, progress):
+    """
+    shutil.copy, counting the bytes copied as they go
+    """
+    import shutil
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            # in the kernel (as shutil.copyfile does), a block at a time
+            offset = 0
+            while True:
+                sent = os.sendfile(destination_file.fileno(), source_file.fileno(), offset, COPY_BLOCK_SIZE)
+                if not sent:
+                    break
+                offset += sent
+                progress.advance(sent)
+        except OSError:
+            # a file system without sendfile: copy the rest through Python
+            source_file.seek(offset)
+            destination_file.seek(offset)
+            while True:
+                block = source_file.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+                destination_file.write(block)
+                progress.advance(len(block))
+    shutil.copymode(source, destination)
+
+
+class ProgressReader:
+    """
+    A file-like upload body of a series of byte strings and files (e.g. a multipart form around a
+    tarball), read as it is sent rather than held in memory, counting the bytes read
+    """
+
+    def __init__(self, parts, progress):
+        """
+        :param parts: byte strings, and paths of files (as str)
+        """
+        import io
+        self._progress = progress
+        self._length = sum(len(part) if isinstance(part, bytes) else os.path.getsize(part) for part in parts)
+        self._parts = [io.BytesIO(part) if isinstance(part, bytes) else open(part, "rb") for part in parts]
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            block = self.read(1024 * 1024)
+            if not block:
+                break
+            yield block
+
+    def read(self, size=-1):
+        blocks = []
+        while self._parts and size != 0:
+            block = self._parts[0].read(size)
+            if not block:
+                self._parts.pop(0).close()
+                continue
+            blocks.append(block)
+            if size > 0:
+                size -= len(block)
+        data = b"".join(blocks)
+        self._progress.advance(len(data))
+        return data
+
+    def close(self):
+        for part in self._parts:
+            part.close()
+        self._parts = []
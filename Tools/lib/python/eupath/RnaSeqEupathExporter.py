@@ -10,7 +10,7 @@ class RnaSeqExporter(EupathExporter.Exporter):
     """
 INPUT
     type specific args:  
-      a list of tuples. 
+      an optional layout, 'per_file' (the default) or 'matrix', then a list of tuples. 
 
     tuple format is: [filepath, samplename, refgenome_key, suffix]
 
@@ -20,9 +20,14 @@ OUTPUT
   files are given cannonical names:
      sample.suffix (with sample name cleaned of icky characters)
 
+  in the matrix layout, the txt files are instead merged into one file, expression_matrix.tsv:
+  a gene_id column, holding every gene of any sample once, then one column per sample headed by
+  its sample name.  Genes missing from a sample are NA.  (bw files are still one per sample)
+
   manifest.txt file with one line per tuple:
     for txt file:
       samplename filename strandinfo 
+      (in the matrix layout, filename is expression_matrix.tsv, and the sample is its column)
     for bw file:
       samplename filename strandinfo 
 
@@ -41,10 +46,19 @@ SEE VDI IMPORTER FOR VALIDATION RULES
     TYPE = "RNASeq"
     VERSION = "1.0"
 
+    LAYOUT_PER_FILE = "per_file"
+    LAYOUT_MATRIX = "matrix"
+    MATRIX_FILE_NAME = "expression_matrix.tsv"
+
     def initialize(self, stdArgsBundle, typeSpecificArgsList):
 
         super().initialize(stdArgsBundle, RnaSeqExporter.TYPE, RnaSeqExporter.VERSION)
 
+        self._layout = RnaSeqExporter.LAYOUT_PER_FILE
+        if typeSpecificArgsList and typeSpecificArgsList[0] in (RnaSeqExporter.LAYOUT_PER_FILE, RnaSeqExporter.LAYOUT_MATRIX):
+            self._layout = typeSpecificArgsList[0]
+            typeSpecificArgsList = typeSpecificArgsList[1:]
+
         if len(typeSpecificArgsList) < 4:
             print("The tool was passed an insufficient numbers of arguments.", file=sys.stderr)
             exit(1)
@@ -62,11 +76,19 @@ SEE VDI IMPORTER FOR VALIDATION RULES
             print("All input datasets must have valid, and identical, reference genomes", file=sys.stderr)
             exit(1)
 
-        self._datasetInfos = []
+        (self._datasetInfos, self._matrixSamples, self._manifestLines) = self.build_dataset_infos(typeSpecificArgsList)
 
-        # open manifest file for writing
-        manifestPath = "/tmp/manifest." + str(os.getpid()) + ".txt"
-        manifest = open(manifestPath, "w+")
+        # print >> sys.stderr, "datasetInfos: " + json.dumps(self._datasetInfos) + "<<- END OF datasetInfos"
+
+    def build_dataset_infos(self, typeSpecificArgsList):
+        """
+        Name the dataset file of each [filepath, samplename, refgenome_key, suffix] tuple.
+        :return: the dataset file list (see identify_dataset_files), the [samplename, filepath] of the
+        samples to merge into the matrix (in the matrix layout), and the lines of the manifest
+        """
+        datasetInfos = []
+        matrixSamples = []
+        manifestLines = []
 
         # process variable number of [filepath, samplename, refgenome_key, suffix] tubles
         fileNumber = 0
@@ -87,13 +109,39 @@ SEE VDI IMPORTER FOR VALIDATION RULES
             fileNumber += 1
             strandedness = "unstranded"
 
-            self._datasetInfos.append({"name": filename, "path": path})
-            print(samplename + "\t" + filename + "\t" + strandedness, file=manifest)
+            if self._layout == RnaSeqExporter.LAYOUT_MATRIX and suffix == "txt":
+                filename = RnaSeqExporter.MATRIX_FILE_NAME
+                matrixSamples.append([samplename, path])
+            else:
+                datasetInfos.append({"name": filename, "path": path})
+            manifestLines.append(samplename + "\t" + filename + "\t" + strandedness + "\n")
 
-        manifest.close()
-        self._datasetInfos.append({"name": "manifest.txt", "path": manifestPath})
+        return (datasetInfos, matrixSamples, manifestLines)
 
-        # print >> sys.stderr, "datasetInfos: " + json.dumps(self._datasetInfos) + "<<- END OF datasetInfos"
+    def prepare_data_files(self, temp_path):
+        """
+        Copy the dataset files, and write the manifest beside them
+        """
+        super().prepare_data_files(temp_path)
+        if self._matrixSamples:
+            write_expression_matrix(temp_path + "/" + RnaSeqExporter.MATRIX_FILE_NAME, self._matrixSamples)
+        with open(temp_path + "/manifest.txt", "w") as manifest:
+            manifest.writelines(self._manifestLines)
+
+    def dataset_files_size(self):
+        return super().dataset_files_size() + sum(os.path.getsize(path) for (samplename, path) in self._matrixSamples)
+
+    def shardable(self):
+        """
+        Samples' files are independent, except in the matrix layout
+        """
+        return not self._matrixSamples
+
+    def shard(self, dataset_files, number, count):
+        shard = super().shard(dataset_files, number, count)
+        filenames = set(dataset_file['name'] for dataset_file in dataset_files)
+        shard._manifestLines = [line for line in self._manifestLines if line.split("\t")[1] in filenames]
+        return shard
 
     def identify_dependencies(self):
         """
@@ -113,3 +161,69 @@ SEE VDI IMPORTER FOR VALIDATION RULES
         :return: A list containing the dataset files accompanied by their VEuPathDB designation.
         """
         return self._datasetInfos
+
+
+
+def read_expression_file(samplename, path):
+    """
+    Read a two column file of gene ids and values (as written by TPMtool or FPKMtool), after its header line
+    :return: (the list of gene ids, an array of the values' text), as bytes: a numpy str array takes
+    four bytes a character, and the values are only copied
+    """
+    import numpy as np
+    with open(path, "rb") as expression:
+        expression.readline()
+        fields = expression.read().split()
+    if len(fields) % 2:
+        print("The file of sample " + samplename + " is not a two column file of gene ids and values.", file=sys.stderr)
+        exit(1)
+    return fields[0::2], np.array(fields[1::2], dtype=bytes)
+
+
+def write_expression_matrix(path, matrixSamples, blockRows=10000):
+    """
+    Merge the files of many samples into one genes x samples matrix, with a row for every gene in any
+    of them, in order of first appearance.  A gene repeated within a sample keeps its last value.
+    Gene ids and values are copied (as bytes) as they are written in the files.
+    :param matrixSamples: list of [samplename, filepath]
+    """
+    import itertools
+    import numpy as np
+    from .Normalization import first_position_last_value
+
+    # samples usually share one layout of gene ids (all from TPMtool, with the same gene models), so
+    # each run of samples with the same layout is collapsed and joined once
+    layouts = []        # [a layout's ids, its unique ids, the position of each unique id's value]
+    sampleColumns = []  # (layout number, values followed by an NA)
+    for samplename, filepath in matrixSamples:
+        ids, values = read_expression_file(samplename, filepath)
+        if not layouts or layouts[-1][0] != ids:
+            uniqueIds, positions = first_position_last_value(ids, np.arange(len(ids)))
+            layouts.append([ids, uniqueIds, positions])
+        sampleColumns.append((len(layouts) - 1, np.append(values, b"NA")))
+
+    # one join of the layouts' ids against their union
+    allIds = np.concatenate([uniqueIds for (ids, uniqueIds, positions) in layouts])
+    geneIds, first, inverse = np.unique(allIds, return_index=True, return_inverse=True)
+    byAppearance = np.argsort(first, kind='stable')
+    rowOfGene = np.empty(len(geneIds), dtype=np.int64)
+    rowOfGene[byAppearance] = np.arange(len(geneIds))
+    geneIds = geneIds[byAppearance]
+
+    # for each layout, the position of each row's value, or -1 (the NA) if it doesn't have the gene
+    valuePositions = []
+    start = 0
+    for (ids, uniqueIds, positions) in layouts:
+        rowPositions = np.full(len(geneIds), -1, dtype=np.int64)
+        rowPositions[rowOfGene[inverse[start:start + len(uniqueIds)]]] = positions
+        valuePositions.append(rowPositions)
+        start += len(uniqueIds)
+
+    rowFormat = b"%s" + b"\t%s" * len(matrixSamples) + b"\n"
+    with open(path, "wb") as out:
+        out.write(("gene_id\t" + "\t".join(samplename for (samplename, filepath) in matrixSamples) + "\n").encode())
+        for blockStart in range(0, len(geneIds), blockRows):
+            rows = slice(blockStart, blockStart + blockRows)
+            columns = [values[valuePositions[layout][rows]].tolist() for (layout, values) in sampleColumns]
+            blockIds = geneIds[rows].tolist()
+            out.write((rowFormat * len(blockIds)) % tuple(itertools.chain.from_iterable(zip(blockIds, *columns))))
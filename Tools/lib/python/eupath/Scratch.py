@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+import fcntl
+import json
+import os
+import shutil
+import sys
+from .Admission import pid_alive
+
+# Scratch space for the exporters' working directories (the staged dataset files and the tarball).
+#
+# The directory is made on the fastest configured scratch root with room for the export: tmpfs
+# first, then local SSD, then the rest, in config order within each kind.  Room is checked before
+# anything is copied, and reserved, so that exporters starting together do not all pick the same
+# nearly full root and fail later with ENOSPC.
+#
+# Each root holds the directories in eupath-export-scratch/, each beside a <dir>.reservation file
+# recording its host, pid and reserved bytes.  Directories of exporters that died (killed jobs, or
+# removal that failed) are removed by the next exporter to use the root on the same host.
+#
+# Configured by these (optional) config.json keys:
+#   scratch-roots           list of directories to make scratch directories under (default: the system temp dir)
+#   scratch-headroom-bytes  space to leave free on a root (default 100MB)
+
+SCRATCH_SUBDIR = "eupath-export-scratch"
+RESERVATION_SUFFIX = ".reservation"
+DEFAULT_HEADROOM_BYTES = 100 * 1024 * 1024
+
+# speed ranks of kinds of filesystem
+TMPFS, SSD, OTHER = 0, 1, 2
+
+
+class ScratchSpaceError(Exception):
+    """
+    No scratch root has room for an export.
+    """
+    pass
+
+
+def disk_usage(path):
+    """
+    :return: the bytes allocated to the files under a directory
+    """
+    total = 0
+    for directory, subdirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def filesystem_rank(path):
+    """
+    :return: TMPFS, SSD or OTHER, for the filesystem holding a path
+    """
+    path = os.path.realpath(path)
+    mount_point, fs_type, device = "", None, None
+    try:
+        with open("/proc/mounts") as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                point = fields[1].replace("\\040", " ")
+                if (path == point or path.startswith(point.rstrip("/") + "/")) and len(point) >= len(mount_point):
+                    mount_point, device, fs_type = point, fields[0], fields[2]
+    except OSError:
+        return OTHER
+
+    if fs_type in ("tmpfs", "ramfs"):
+        return TMPFS
+    if device and device.startswith("/dev/"):
+        # a partition's queue is its disk's
+        block = os.path.realpath("/sys/class/block/" + os.path.basename(os.path.realpath(device)))
+        for queue in (os.path.join(block, "queue"), os.path.join(block, "..", "queue")):
+            try:
+                with open(os.path.join(queue, "rotational")) as rotational:
+                    return SSD if rotational.read().strip() == "0" else OTHER
+            except OSError:
+                continue
+    return OTHER
+
+
+class ScratchManager:
+
+    def __init__(self, roots, headroom_bytes=DEFAULT_HEADROOM_BYTES):
+        """
+        :param roots: directories to make scratch directories under, in order of preference within each kind of filesystem
+        """
+        self._roots = sorted(roots, key=filesystem_rank)
+        self._headroom_bytes = headroom_bytes
+        self._host = os.uname().nodename
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: the parsed config.json
+        """
+        import tempfile
+        return cls(config.get("scratch-roots") or [tempfile.gettempdir()],
+                   int(config.get("scratch-headroom-bytes", DEFAULT_HEADROOM_BYTES)))
+
+    def reserve(self, dir_name, size):
+        """
+        Make a scratch directory, on the first root with this much space free (after other exporters' reservations)
+        :param dir_name: name of the directory, unique on the host
+        :param size: the most bytes the directory will hold
+        :return: the directory's path
+        """
+        shortfalls = []
+        for root in self._roots:
+            base = os.path.join(root, SCRATCH_SUBDIR)
+            try:
+                os.makedirs(base, exist_ok=True)
+                with self._locked(base):
+                    self._collect_garbage(base)
+                    available = self._available(base)
+                    if available - self._headroom_bytes < size:
+                        shortfalls.append("%s has %d MB available" % (root, available // 1048576))
+                        continue
+                    path = os.path.join(base, dir_name)
+                    with open(path + RESERVATION_SUFFIX, "w") as reservation:
+                        json.dump({"host": self._host, "pid": os.getpid(), "bytes": size}, reservation)
+                    os.mkdir(path)
+                    return path
+            except OSError as e:
+                shortfalls.append("%s is not usable: %s" % (root, e))
+        raise ScratchSpaceError("Not enough scratch space for this export (%d MB needed): %s" % (size // 1048576, "; ".join(shortfalls)))
+
+    def release(self, path):
+        """
+        Remove a scratch directory and its reservation.  If the directory can't be removed, the
+        reservation is kept, for the directory to be collected later
+        """
+        # ignore errors: the top level of the temp dir can't be removed in the Globus Dev Galaxy instance
+        shutil.rmtree(path, True)
+        if os.path.exists(path):
+            print("Could not remove scratch directory " + path, file=sys.stderr)
+            return
+        try:
+            os.unlink(path + RESERVATION_SUFFIX)
+        except OSError:
+            pass
+
+    def _locked(self, base):
+        lock = open(os.path.join(base, ".lock"), "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock  # closing it releases the lock
+
+    def _reservations(self, base):
+        for name in os.listdir(base):
+            if name.endswith(RESERVATION_SUFFIX):
+                path = os.path.join(base, name)
+                try:
+                    with open(path) as reservation:
+                        yield path[:-len(RESERVATION_SUFFIX)], json.load(reservation)
+                except (OSError, ValueError):
+                    continue
+
+    def _collect_garbage(self, base):
+        """
+        Remove the directories of this host's exporters that are no longer running
+        """
+        for path, reservation in list(self._reservations(base)):
+            if reservation.get("host") == self._host and not pid_alive(reservation.get("pid", 0)):
+                print("Removing scratch directory of dead process %s: %s" % (reservation.get("pid"), path), file=sys.stderr)
+                self.release(path)
+
+    def _available(self, base):
+        """
+        :return: the bytes free on a root's filesystem, less what its exporters have reserved but not yet used
+        """
+        stats = os.statvfs(base)
+        available = stats.f_bavail * stats.f_frsize
+        for path, reservation in self._reservations(base):
+            available -= max(0, reservation.get("bytes", 0) - disk_usage(path))
+        return available
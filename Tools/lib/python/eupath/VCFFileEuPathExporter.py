@@ -1,57 +1,207 @@
 from . import EupathExporter
 from . import ReferenceGenome
+from . import Bgzf
 import sys
 import os
-import subprocess
+import re
 
 
-class VCFFileExport(EupathExporter.Export):
+class VCFFileExporter(EupathExporter.Exporter):
+    """
+INPUT
+    type specific args:
+      one or more tuples of: [filepath, filename, refgenome_key]
+        - all files must have the same ref genome
+
+OUTPUT
+  each VCF, validated, BGZF compressed with a tabix index beside it:
+     filename.gz, filename.gz.tbi (with filename cleaned of icky characters)
+
+  manifest.txt file with one line per VCF: its file in the tarball (filename.gz, cleaned as above)
+
+  dependency info:
+   - reference genome and version (unanimous consensus of the files provided)
+    """
 
     # Constants
     TYPE = "VCFFile"
     VERSION = "1.0"
 
-    def __init__(self, args):
-        EupathExporter.Export.__init__(self,
-                                       VCFFileExport.TYPE,
-                                       VCFFileExport.VERSION,
-                                       'validateVCF',
-                                       args)
+    def initialize(self, stdArgsBundle, typeSpecificArgsList):
 
-        self._datasetInfos = []
+        super().initialize(stdArgsBundle, VCFFileExporter.TYPE, VCFFileExporter.VERSION)
 
-        # open manifest file
-        manifestPath = "/tmp/manifest." + str(os.getpid()) + ".txt"
-        manifest = open(manifestPath, "w+")
+        if len(typeSpecificArgsList) < 3:
+            print("The tool was passed an insufficient numbers of arguments.", file=sys.stderr)
+            exit(1)
 
-        for i in range(6, len(args), 2):
-            print(i, args[i], file=sys.stdout)
-            samplename = args[i+1]
-            #filename = samplename + "." + args[i+2]
-        ## Note in the xml this will need the right variables passed in - e.g. sample name, file format.
-        
+        if len(typeSpecificArgsList) % 3 != 0:
+            print("Invalid number of arguments.  Must be one or more 3-tuples.", file=sys.stderr)
+            exit(1)
 
-            self._datasetInfos.append({"name": samplename, "path": args[i]})
-            print(samplename, file=manifest)
-                
+        # grab ref genome from first tuple.  all others must agree
+        self._refGenomeKey = typeSpecificArgsList[2]
+        try:
+            self._refGenome = ReferenceGenome.Genome(self._refGenomeKey)
+        except:
+            print("All input datasets must have valid, and identical, reference genomes", file=sys.stderr)
+            exit(1)
 
-        self._datasetInfos.append({"name": "manifest.txt", "path": manifestPath})
-        
-        # Need this? 
-        # self._refGenome = ReferenceGenome.Genome(args[10])
+        self._datasetInfos = []
+        for i in range(0, len(typeSpecificArgsList), 3):   # increment by tuple size (3)
+            path = typeSpecificArgsList[i+0]
+            filename = typeSpecificArgsList[i+1]
+            refGenomeKey = typeSpecificArgsList[i+2]
 
+            if refGenomeKey != self._refGenomeKey:
+                print("All datasets must have the same reference genome identifier and version. File " + filename + " does not agree with the others.  The value it has is: " + refGenomeKey, file=sys.stderr)
+                exit(1)
 
-        # if len(args) < 10:
-        #     raise EupathExporter.ValidationException("The tool was passed too few arguments.")
+            self._datasetInfos.append({"name": filename, "path": path})
+
+    def identify_dependencies(self):
+        """
+        The appropriate dependency(ies) will be determined by the reference genome selected - only one for now
+        """
+        return [{
+            "resourceIdentifier": self._refGenome.identifier,
+            "resourceVersion": self._refGenome.version,
+            "resourceDisplayName": self._refGenome.display_name
+        }]
+
+    def identify_projects(self):
+        return [self._refGenome.project]
 
-        
     def identify_dataset_files(self):
         """
-        :return: A list containing the dataset files accompanied by their EuPathDB designation.
+        :return: A list containing the dataset files accompanied by their VEuPathDB designation.
         """
         return self._datasetInfos
 
+    def prepare_data_files(self, temp_path):
+        """
+        Writes each VCF to the temporary dir BGZF (block gzip) compressed, with a tabix index beside it,
+        so that the server can seek by region.  The VCF is validated, compressed and indexed in one
+        pass over the file; an invalid VCF ends the export before anything is uploaded.
+        The manifest names the compressed files, as they are in the tarball.
+        """
+        manifest_lines = []
+        for dataset_file in self.identify_dataset_files():
+            clean_name = temp_path + "/" + self.clean_file_name(dataset_file['name'])
+            EupathExporter.print_debug("Validating, and creating BGZF and tabix index for: " + clean_name)
+            validator = VcfValidator()
+            try:
+                Bgzf.compress_and_index_vcf(dataset_file['path'], clean_name + ".gz", clean_name + ".gz.tbi",
+                                            EupathExporter.get_galaxy_slots(), validator.check_line)
+                validator.check_end()
+            except VcfValidationException as e:
+                print("VCF file " + dataset_file['name'] + " is not valid: " + str(e), file=sys.stderr)
+                exit(1)
+            except ValueError as e:
+                print("VCF file " + dataset_file['name'] + " could not be indexed: " + str(e), file=sys.stderr)
+                exit(1)
+            self._progress.advance(os.path.getsize(dataset_file['path']))
+            manifest_lines.append(self.clean_file_name(dataset_file['name']) + ".gz\n")
 
-    def identify_projects(self):
+        with open(temp_path + "/manifest.txt", "w") as manifest:
+            manifest.writelines(manifest_lines)
 
-        return [self._refGenome.project]
+
+class VcfValidationException(ValueError):
+    """
+    A VCF does not conform to the VCF 4.x specification.
+    """
+    pass
+
+
+class VcfValidator:
+    """
+    Checks a VCF's structure line by line, as it is read (see Bgzf.compress_and_index_vcf's line_handler):
+    the fileformat line, meta lines before the header line, the header's fixed columns, and each data
+    line's column count, POS, REF, ALT, QUAL and INFO.  Sort order is checked by the tabix indexing.
+    Raises VcfValidationException at the first problem.
+    """
+
+    FIXED_COLUMNS = [b"#CHROM", b"POS", b"ID", b"REF", b"ALT", b"QUAL", b"FILTER", b"INFO"]
+    FORMAT_COLUMN = b"FORMAT"
+    BASES_PATTERN = rb"[ACGTNacgtn]+"
+    ALT_ALLELE_PATTERN = rb"(?:[ACGTNacgtn*]+|<[^<>\t]+>|\.[ACGTNacgtn]+|[ACGTNacgtn]+\.|[^,\t]*[\[\]][^,\t]*)"
+    QUAL_PATTERN = rb"(?:\.|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+    INFO_ENTRY_PATTERN = rb"(?:[A-Za-z_][0-9A-Za-z_.]*(?:=[^;=\t]*)?|1000G)"
+    BASES = re.compile(rb"^" + BASES_PATTERN + rb"$")
+    ALT_ALLELE = re.compile(rb"^" + ALT_ALLELE_PATTERN + rb"$")
+    QUAL = re.compile(rb"^" + QUAL_PATTERN + rb"$")
+    INFO_ENTRY = re.compile(rb"^" + INFO_ENTRY_PATTERN + rb"$")
+    # the checks of the fixed columns in one match, for the common case of a valid line; when it fails,
+    # the columns are checked one by one, to say what is wrong
+    RECORD = re.compile(rb"^[^\t ]+\t\d+\t[^\t]*\t" + BASES_PATTERN + rb"\t(?:\.|" + ALT_ALLELE_PATTERN + rb"(?:," + ALT_ALLELE_PATTERN
+                        + rb")*)\t" + QUAL_PATTERN + rb"\t[^\t]+\t(?:\.|" + INFO_ENTRY_PATTERN + rb"(?:;" + INFO_ENTRY_PATTERN
+                        + rb")*)(?:$|\t[^\t]+(?:\t|$))")
+
+    def __init__(self):
+        self._line_number = 0
+        self._columns = None    # the number of columns, once the header line is read
+
+    def check_line(self, line):
+        self._line_number += 1
+        line = line.rstrip(b"\r\n")
+        if self._line_number == 1 and not line.startswith(b"##fileformat=VCFv4"):
+            self._fail("the first line must declare the format, e.g. ##fileformat=VCFv4.2")
+        if line.startswith(b"##"):
+            if self._columns is not None:
+                self._fail("meta-information lines (##) must come before the header line (#CHROM)")
+        elif line.startswith(b"#"):
+            self._check_header(line)
+        elif line.strip():
+            self._check_record(line)
+
+    def check_end(self):
+        if self._columns is None:
+            raise VcfValidationException("there is no header line (#CHROM POS ID REF ALT QUAL FILTER INFO ...)")
+
+    def _check_header(self, line):
+        if self._columns is not None:
+            self._fail("there is more than one header line (#CHROM)")
+        columns = line.split(b"\t")
+        if columns[:8] != VcfValidator.FIXED_COLUMNS:
+            self._fail("the header line must start with the tab separated columns " + " ".join(c.decode() for c in VcfValidator.FIXED_COLUMNS))
+        if len(columns) > 8:
+            if columns[8] != VcfValidator.FORMAT_COLUMN:
+                self._fail("the header line's ninth column must be FORMAT, followed by the samples")
+            samples = columns[9:]
+            if len(set(samples)) != len(samples):
+                self._fail("the header line has repeated sample names")
+        self._columns = len(columns)
+
+    def _check_record(self, line):
+        if self._columns is None:
+            self._fail("data lines must come after the header line (#CHROM)")
+        if line.count(b"\t") == self._columns - 1 and VcfValidator.RECORD.match(line):
+            return
+        fields = line.split(b"\t")
+        if len(fields) != self._columns:
+            self._fail("has " + str(len(fields)) + " columns where the header line has " + str(self._columns))
+        (chrom, pos, id, ref, alt, qual, filter, info) = fields[:8]
+        if not chrom or b" " in chrom:
+            self._fail("CHROM must not be empty or contain spaces")
+        if not pos.isdigit():
+            self._fail("POS must be a non-negative integer, not '" + pos.decode(errors="replace") + "'")
+        if not VcfValidator.BASES.match(ref):
+            self._fail("REF must be bases (A, C, G, T or N), not '" + ref.decode(errors="replace") + "'")
+        if alt != b".":
+            for allele in alt.split(b","):
+                if not VcfValidator.ALT_ALLELE.match(allele):
+                    self._fail("ALT allele '" + allele.decode(errors="replace") + "' is not valid")
+        if not VcfValidator.QUAL.match(qual):
+            self._fail("QUAL must be a number or '.', not '" + qual.decode(errors="replace") + "'")
+        if not filter:
+            self._fail("FILTER must not be empty")
+        if info != b".":
+            for entry in info.split(b";"):
+                if not VcfValidator.INFO_ENTRY.match(entry):
+                    self._fail("INFO entry '" + entry.decode(errors="replace") + "' is not valid")
+        if self._columns > 8 and not fields[8]:
+            self._fail("FORMAT must not be empty")
+
+    def _fail(self, message):
+        raise VcfValidationException("line " + str(self._line_number) + ": " + message)
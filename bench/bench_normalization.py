@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Benchmark for the TPM and FPKM tools on a human-scale (60k gene) synthetic annotation.
+#
+# Generates a GFF3 and sense/antisense htseq-count files, then times TPMtool and FPKMtool end to end,
+# both parsing the GFF and reading it from the gene model index cache (as for built-in annotations).
+# Given --reference-dir (a directory holding other versions of TPMtool and FPKMtool, e.g. checked out
+# from an earlier commit), times those too and confirms the outputs are byte-for-byte identical.
+#
+# usage: bench_normalization.py [--genes N] [--repeat N] [--reference-dir DIR]
+
+import argparse
+import filecmp
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from generators import write_counts, write_gff
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TOOLS_BIN = os.path.join(ROOT, "Tools", "bin")
+TOOLS_LIB = os.path.join(ROOT, "Tools", "lib", "python")
+
+
+def run_tool(tool_dir, tool, args, cache_dir):
+    env = dict(os.environ, PYTHONPATH=TOOLS_LIB, EUPATH_GENE_MODEL_CACHE=cache_dir)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(tool_dir, tool)] + args, check=True, env=env, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def tool_args(tool, data, outputs):
+    args = ["--genome", data["gff"], "--input", data["sense"], "--antisense_input", data["antisense"],
+            "--output", outputs[0], "--antisense_output", outputs[1]]
+    return args + (["--stranded"] if tool == "TPMtool" else ["--double_stranded", "y"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--genes", type=int, default=60000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reference-dir", help="directory with TPMtool and FPKMtool to compare against")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as work:
+        data = {"gff": os.path.join(work, "genes.gff3"), "sense": os.path.join(work, "sense.txt"), "antisense": os.path.join(work, "antisense.txt")}
+        write_gff(data["gff"], args.genes, rng)
+        write_counts(data["sense"], args.genes, rng)
+        write_counts(data["antisense"], args.genes, rng)
+
+        for tool in ["TPMtool", "FPKMtool"]:
+            versions = [("current", TOOLS_BIN, []), ("cached", TOOLS_BIN, ["--cache_gene_models"])]
+            if args.reference_dir:
+                versions.append(("reference", args.reference_dir, []))
+            produced = {}
+            for label, tool_dir, extra_args in versions:
+                outputs = [os.path.join(work, "%s.%s.%s" % (tool, label, strand)) for strand in ("sense", "antisense")]
+                run_args = tool_args(tool, data, outputs) + extra_args
+                if extra_args:
+                    run_tool(tool_dir, tool, run_args, os.path.join(work, "cache"))  # warm the cache
+                times = [run_tool(tool_dir, tool, run_args, os.path.join(work, "cache")) for i in range(args.repeat)]
+                produced[label] = outputs
+                print("%-9s %-9s genes=%d best=%.3fs mean=%.3fs" % (tool, label, args.genes, min(times), sum(times) / len(times)))
+            if args.reference_dir:
+                identical = all(filecmp.cmp(a, b, shallow=False) for label in ("current", "cached")
+                                for a, b in zip(produced[label], produced["reference"]))
+                print("%-9s output identical to reference: %s" % (tool, identical))
+                if not identical:
+                    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark for orthomclBlastParserTabular on synthetic BLAST tabular output.
+#
+# Generates BLAST -outfmt "6 std qlen slen" rows (queries sorted, a realistic spread of evalues,
+# including 0.0 and the e-180 style values BLAST prints), then converts them with one worker and
+# with --workers, from plain and gzipped input.  Given --reference-dir (a directory holding another
+# version of orthomclBlastParserTabular, e.g. checked out from an earlier commit), times that too
+# and confirms the outputs are identical.
+#
+# usage: bench_orthomcl_blast_parser.py [--rows N] [--workers N] [--repeat N] [--reference-dir DIR]
+
+import argparse
+import gzip
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TOOLS_BIN = os.path.join(ROOT, "Tools", "bin")
+PARSER = "orthomclBlastParserTabular"
+
+
+def random_evalue(rng):
+    roll = rng.random()
+    if roll < 0.2:
+        return "0.0"
+    if roll < 0.7:
+        return "%.1fe-%02d" % (rng.uniform(1, 9.9), rng.randint(5, 180))
+    if roll < 0.9:
+        return "%.2e" % (rng.uniform(1, 9.99) * 10 ** -rng.randint(1, 4))
+    return "%.3f" % rng.uniform(0, 10)
+
+
+def write_blast(path, rows, rng):
+    with open(path, "w") as blast:
+        written = 0
+        query = 0
+        while written < rows:
+            qlen = rng.randint(50, 3000)
+            for hit in range(min(rng.randint(1, 50), rows - written)):
+                slen = rng.randint(50, 3000)
+                length = rng.randint(30, min(qlen, slen))
+                qstart = rng.randint(1, qlen - length + 1)
+                sstart = rng.randint(1, slen - length + 1)
+                blast.write("TAXON|P%07d\tTAXON|P%07d\t%.3f\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s\t%.1f\t%d\t%d\n" % (
+                    query, rng.randint(0, 10000000), rng.uniform(20, 100), length, rng.randint(0, length // 2),
+                    rng.randint(0, 10), qstart, qstart + length - 1, sstart, sstart + length - 1,
+                    random_evalue(rng), rng.uniform(20, 2000), qlen, slen))
+                written += 1
+            query += 1
+
+
+def run_parser(tool_dir, args):
+    start = time.perf_counter()
+    subprocess.run(["perl", os.path.join(tool_dir, PARSER)] + args, check=True)
+    return time.perf_counter() - start
+
+
+def read_output(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reference-dir", help="directory with an orthomclBlastParserTabular to compare against")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as work:
+        blast = os.path.join(work, "blast.tsv")
+        write_blast(blast, args.rows, rng)
+        with open(blast, "rb") as plain, gzip.open(blast + ".gz", "wb", compresslevel=6) as compressed:
+            shutil.copyfileobj(plain, compressed)
+
+        versions = [("1 worker", TOOLS_BIN, blast, "out.1.txt", []),
+                    ("%d workers" % args.workers, TOOLS_BIN, blast, "out.n.txt", ["--workers", str(args.workers)]),
+                    ("gzip, 1 worker", TOOLS_BIN, blast + ".gz", "out.gz1.txt.gz", []),
+                    ("gzip, %d workers" % args.workers, TOOLS_BIN, blast + ".gz", "out.gzn.txt.gz", ["--workers", str(args.workers)])]
+        if args.reference_dir:
+            versions.insert(0, ("reference", args.reference_dir, blast, "out.ref.txt", []))
+
+        outputs = []
+        for label, tool_dir, input, output, extra_args in versions:
+            output = os.path.join(work, output)
+            times = [run_parser(tool_dir, extra_args + [input, "TAXON", output]) for i in range(args.repeat)]
+            outputs.append(output)
+            print("%-18s rows=%d best=%.3fs mean=%.3fs rows/s=%.0f" % (label, args.rows, min(times),
+                  sum(times) / len(times), args.rows / min(times)))
+
+        expected = read_output(outputs[0])
+        identical = all(read_output(output) == expected for output in outputs[1:])
+        print("outputs identical: %s" % identical)
+        if not identical:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark for orthomclMapProteomeToGroupsGalaxy on a synthetic proteome mapping.
+#
+# Generates an OrthoMCL groups file, a similarity file of the input proteome against the OrthoMCL
+# proteins and a self similarity file (both sorted by query, as blastSimilarity writes them), then
+# maps the proteome with one worker and with --workers, looking proteins up in the groups file and
+# in its index (orthomclBuildGroupsIndex).  Confirms that every run's outputs are identical.
+#
+# usage: bench_orthomcl_map.py [--proteins N] [--queries N] [--workers N] [--repeat N]
+
+import argparse
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TOOLS_BIN = os.path.join(ROOT, "Tools", "bin")
+MAPPER = "orthomclMapProteomeToGroupsGalaxy"
+INDEXER = "orthomclBuildGroupsIndex"
+TAXON = "TAXA"
+
+
+def write_groups(path, proteins, group_size):
+    with open(path, "w") as groups:
+        for first in range(0, proteins, group_size):
+            members = " ".join("prot%07d" % p for p in range(first, min(first + group_size, proteins)))
+            groups.write("OG_%d: %s\n" % (first // group_size, members))
+
+
+def write_similarities(path, queries, subjects, rng):
+    """
+    Each query's hits, best first.  Subjects are ids from the subjects function, some of them in no group
+    """
+    with open(path, "w") as similarities:
+        for q in range(queries):
+            exponent = -rng.randint(5, 180)
+            for hit in range(rng.randint(1, 8)):
+                similarities.write("%s|q%06d %s %s OG %.2f %d %d %d\n" % (
+                    TAXON, q, subjects(rng), TAXON, rng.uniform(1, 9.99), exponent, rng.randint(20, 100), rng.randint(30, 100)))
+                exponent += rng.randint(0, 20)
+
+
+def run_mapper(args):
+    start = time.perf_counter()
+    subprocess.run(["perl", os.path.join(TOOLS_BIN, MAPPER)] + args, check=True, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def read_outputs(prefix):
+    outputs = []
+    for suffix in (".groups", ".paralogs"):
+        with open(prefix + suffix, "rb") as f:
+            outputs.append(f.read())
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proteins", type=int, default=200000, help="OrthoMCL proteins in groups")
+    parser.add_argument("--queries", type=int, default=60000, help="proteins of the input proteome")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as work:
+        groups = os.path.join(work, "groups.txt")
+        similarities = os.path.join(work, "similarities.txt")
+        self_similarities = os.path.join(work, "self_similarities.txt")
+        write_groups(groups, args.proteins, 10)
+        # a tenth of the hits are to proteins in no group
+        write_similarities(similarities, args.queries,
+                           lambda rng: "prot%07d" % rng.randint(0, args.proteins * 11 // 10), rng)
+        write_similarities(self_similarities, args.queries,
+                           lambda rng: "%s|q%06d" % (TAXON, rng.randint(0, args.queries - 1)), rng)
+
+        runs = [("hash, 1 worker", False, 1), ("hash, %d workers" % args.workers, False, args.workers),
+                ("index, 1 worker", True, 1), ("index, %d workers" % args.workers, True, args.workers)]
+        outputs = []
+        for label, indexed, workers in runs:
+            if indexed and not os.path.exists(groups + ".proteinIndex"):
+                subprocess.run(["perl", os.path.join(TOOLS_BIN, INDEXER), groups], check=True)
+            prefix = os.path.join(work, "out.%d.%d" % (indexed, workers))
+            times = [run_mapper(["--workers", str(workers), self_similarities, similarities, groups, TAXON,
+                                 prefix + ".groups", prefix + ".paralogs"]) for i in range(args.repeat)]
+            outputs.append(read_outputs(prefix))
+            print("%-18s queries=%d best=%.3fs mean=%.3fs" % (label, args.queries, min(times), sum(times) / len(times)))
+
+        identical = all(output == outputs[0] for output in outputs[1:])
+        print("outputs identical: %s" % identical)
+        if not identical:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
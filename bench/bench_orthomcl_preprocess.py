@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Benchmark for orthomclPreprocessProteomeFasta on a proteome at the Galaxy tool's default
+# max_allowed_input_seqs (100000 sequences).
+#
+# Generates a protein FASTA with wrapped sequence lines, a few tabs in deflines and some partly
+# masked (X) sequence lines, then times the preprocessor.  Given --reference-dir (a directory holding
+# another version of orthomclPreprocessProteomeFasta, e.g. checked out from an earlier commit), times
+# that too and confirms the outputs are identical.
+#
+# usage: bench_orthomcl_preprocess.py [--sequences N] [--repeat N] [--reference-dir DIR]
+
+import argparse
+import filecmp
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TOOLS_BIN = os.path.join(ROOT, "Tools", "bin")
+PREPROCESSOR = "orthomclPreprocessProteomeFasta"
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def write_fasta(path, sequences, rng):
+    with open(path, "w") as fasta:
+        for s in range(sequences):
+            separator = "\t" if rng.random() < 0.1 else " "
+            fasta.write(">PROT%06d%sprotein %d [Organism bench]\n" % (s, separator, s))
+            length = int(rng.lognormvariate(6, 0.6)) + 20
+            sequence = "".join(rng.choice(AMINO_ACIDS) for i in range(length))
+            if rng.random() < 0.05:
+                start = rng.randint(0, length - 1)
+                sequence = sequence[:start] + "X" * min(60, length - start) + sequence[start + 60:]
+            for start in range(0, len(sequence), 60):
+                fasta.write(sequence[start:start + 60] + "\n")
+
+
+def run_preprocessor(tool_dir, fasta, sequences, output):
+    start = time.perf_counter()
+    subprocess.run(["perl", os.path.join(tool_dir, PREPROCESSOR), fasta, str(sequences), "xxxx", output], check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sequences", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--reference-dir", help="directory with an orthomclPreprocessProteomeFasta to compare against")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as work:
+        fasta = os.path.join(work, "proteome.fasta")
+        write_fasta(fasta, args.sequences, rng)
+
+        versions = [("current", TOOLS_BIN)]
+        if args.reference_dir:
+            versions.append(("reference", args.reference_dir))
+        outputs = []
+        for label, tool_dir in versions:
+            output = os.path.join(work, "clean.%s.fasta" % label)
+            times = [run_preprocessor(tool_dir, fasta, args.sequences, output) for i in range(args.repeat)]
+            outputs.append(output)
+            print("%-9s sequences=%d best=%.3fs mean=%.3fs" % (label, args.sequences, min(times), sum(times) / len(times)))
+
+        if args.reference_dir:
+            identical = filecmp.cmp(outputs[0], outputs[1], shallow=False)
+            print("output identical to reference: %s" % identical)
+            if not identical:
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Startup (import) cost of each Python entry point in Tools/bin, against a budget.
+#
+# For each tool, runs just its top-level import statements in a fresh interpreter under
+# `python -X importtime`, and totals the time spent importing the modules that the interpreter
+# itself doesn't load at startup.  The best of --repeat runs is taken (a first, discarded run warms
+# the bytecode caches, as on a Galaxy server).  Reports each tool's cost and its heaviest imports,
+# and exits non-zero if any tool is over budget.  Tools whose imports fail here (a dependency that is
+# not installed, Python 2 code) are reported as skipped.
+#
+# usage: bench_startup.py [--repeat N] [--budget-ms MS] [--tool-budget TOOL=MS ...] [--only TOOL ...]
+
+import argparse
+import ast
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TOOLS_BIN = os.path.join(ROOT, "Tools", "bin")
+TOOLS_LIB = os.path.join(ROOT, "Tools", "lib", "python")
+
+
+def python_entry_points():
+    """
+    :return: {tool name: path} of the Python scripts in Tools/bin
+    """
+    entry_points = {}
+    for name in sorted(os.listdir(TOOLS_BIN)):
+        path = os.path.join(TOOLS_BIN, name)
+        with open(path, "rb") as script:
+            first_line = script.readline()
+        if first_line.startswith(b"#!") and b"python" in first_line:
+            entry_points[name] = path
+    return entry_points
+
+
+def import_statements(path):
+    """
+    :return: the source of a script's top-level import statements
+    """
+    with open(path) as script:
+        tree = ast.parse(script.read(), path)
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def import_times(code, env):
+    """
+    :return: [(cumulative microseconds, depth, module)] for the imports of running code
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    times = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times.append((int(cumulative_us), (len(name) - len(name.lstrip()) - 1) // 2, name.strip()))
+    return times
+
+
+def startup_cost(code, env, interpreter_modules, repeat):
+    """
+    :return: (milliseconds, the heaviest direct imports as [(milliseconds, module)]) of the best run
+    """
+    import_times(code, env)
+    best = None
+    for i in range(repeat):
+        # imports at depth 0 that the bare interpreter doesn't make are the code's own
+        own = [(us, name) for us, depth, name in import_times(code, env) if depth == 0 and name not in interpreter_modules]
+        total = sum(us for us, name in own)
+        if best is None or total < best[0]:
+            best = (total, sorted(own, reverse=True))
+    return best[0] / 1000.0, [(us / 1000.0, name) for us, name in best[1][:5]]
+
+
+def main():
+    entry_points = python_entry_points()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=150.0, help="import time allowed for each tool")
+    parser.add_argument("--tool-budget", nargs="+", default=[], metavar="TOOL=MS", help="budgets for particular tools")
+    parser.add_argument("--only", nargs="+", choices=list(entry_points), help="tools to measure (default all)")
+    args = parser.parse_args()
+    budgets = {tool: float(ms) for tool, ms in (budget.split("=", 1) for budget in args.tool_budget)}
+
+    python_path = os.pathsep.join(filter(None, [TOOLS_LIB, os.getenv("PYTHONPATH")]))
+    env = dict(os.environ, PYTHONPATH=python_path)
+    interpreter_modules = set(name for us, depth, name in import_times("pass", env))
+
+    over_budget = []
+    for tool in args.only or entry_points:
+        budget = budgets.get(tool, args.budget_ms)
+        try:
+            milliseconds, heaviest = startup_cost(import_statements(entry_points[tool]), env, interpreter_modules, args.repeat)
+        except (SyntaxError, RuntimeError) as e:
+            print("%-34s skipped: %s" % (tool, str(e).strip()))
+            continue
+        status = "OVER BUDGET" if milliseconds > budget else "ok"
+        print("%-34s %8.1f ms (budget %.0f) %s" % (tool, milliseconds, budget, status))
+        for ms, module in heaviest:
+            print("%-34s %8.1f ms   %s" % ("", ms, module))
+        if milliseconds > budget:
+            over_budget.append(tool)
+
+    if over_budget:
+        raise SystemExit("Over the startup budget: " + ", ".join(over_budget))
+
+
+if __name__ == "__main__":
+    main()
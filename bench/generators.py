@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Deterministic synthetic inputs for the benchmarks.  Every generator takes a random.Random, so a
+# given seed always produces byte-identical files.
+
+import json
+import os
+
+SPECIAL_COUNTERS = ["__no_feature", "__ambiguous", "__too_low_aQual", "__not_aligned", "__alignment_not_unique"]
+
+
+def gene_id(g):
+    return "GENE%06d" % g
+
+
+def write_gff(path, genes, rng):
+    """
+    GFF3 with `genes` genes on one chromosome, each with 1-3 mRNAs of 1-12 exons
+    """
+    with open(path, "w") as gff:
+        gff.write("##gff-version 3\n")
+        position = 1
+        for g in range(genes):
+            gene = gene_id(g)
+            gff.write("chr1\tbench\tgene\t%d\t%d\t.\t+\t.\tID=%s\n" % (position, position + 5000, gene))
+            for t in range(rng.randint(1, 3)):
+                transcript = "%s.t%d" % (gene, t)
+                gff.write("chr1\tbench\tmRNA\t%d\t%d\t.\t+\t.\tID=%s;Parent=%s\n" % (position, position + 5000, transcript, gene))
+                start = position
+                for e in range(rng.randint(1, 12)):
+                    end = start + rng.randint(50, 400)
+                    gff.write("chr1\tbench\texon\t%d\t%d\t.\t+\t.\tID=%s.e%d;Parent=%s\n" % (start, end, transcript, e, transcript))
+                    start = end + rng.randint(50, 300)
+            position += 6000
+
+
+def write_counts(path, genes, rng):
+    """
+    htseq-count output for the genes of write_gff: mostly gene IDs, some transcript IDs and comma
+    separated transcript lists, then the special counters
+    """
+    with open(path, "w") as counts:
+        for g in range(genes):
+            roll = rng.random()
+            if roll < 0.8:
+                id = gene_id(g)
+            elif roll < 0.95:
+                id = "%s.t0" % gene_id(g)
+            else:
+                id = "%s.t0,%s.t1" % (gene_id(g), gene_id(g))
+            counts.write("%s\t%d\n" % (id, int(rng.expovariate(1 / 500.0))))
+        for special in SPECIAL_COUNTERS:
+            counts.write("%s\t%d\n" % (special, rng.randint(0, 100000)))
+
+
+def write_counts_collection(directory, samples, genes, rng):
+    """
+    htseq-count files for `samples` samples, as a Galaxy list collection would hold them
+    :return: [(sample name, path)]
+    """
+    os.makedirs(directory, exist_ok=True)
+    collection = []
+    for s in range(samples):
+        name = "sample %d" % s
+        path = os.path.join(directory, "counts%d.txt" % s)
+        write_counts(path, genes, rng)
+        collection.append((name, path))
+    return collection
+
+
+def write_tpm_collection(directory, samples, genes, rng):
+    """
+    TPMtool output files (gene_id, TPM) for `samples` samples, as exported to VEuPathDB
+    :return: [(sample name, path)]
+    """
+    os.makedirs(directory, exist_ok=True)
+    collection = []
+    for s in range(samples):
+        name = "sample %d" % s
+        path = os.path.join(directory, "tpm%d.txt" % s)
+        with open(path, "w") as tpm:
+            tpm.write("gene_id\tTPM\n")
+            tpm.write("".join("%s\t%.2f\n" % (gene_id(g), rng.expovariate(1 / 16.0)) for g in range(genes)))
+        collection.append((name, path))
+    return collection
+
+
+def write_biom(path, observations, samples, density, rng):
+    """
+    Sparse BIOM 1.0 (JSON) OTU table, with taxonomy metadata on the observations and one metadata
+    field on the samples.
+    :param density: fraction of the observations x samples cells that are non-zero
+    """
+    cells = observations * samples
+    nonzero = sorted(rng.sample(range(cells), int(cells * density)))
+    data = [[cell // samples, cell % samples, float(rng.randint(1, 1000))] for cell in nonzero]
+    taxonomy = ["k__Bacteria", "p__Firmicutes", "c__Clostridia", "o__Clostridiales", "f__Lachnospiraceae"]
+    table = {
+        "id": "bench",
+        "format": "Biological Observation Matrix 1.0.0",
+        "format_url": "http://biom-format.org",
+        "type": "OTU table",
+        "generated_by": "bench",
+        "date": "2000-01-01T00:00:00",
+        "matrix_type": "sparse",
+        "matrix_element_type": "float",
+        "shape": [observations, samples],
+        "data": data,
+        "rows": [{"id": "OTU%06d" % o, "metadata": {"taxonomy": taxonomy + ["g__%d" % (o % 500)]}} for o in range(observations)],
+        "columns": [{"id": "SAMPLE%04d" % s, "metadata": {"body_site": rng.choice(["gut", "skin", "oral"])}} for s in range(samples)],
+    }
+    with open(path, "w") as biom:
+        json.dump(table, biom)
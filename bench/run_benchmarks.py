@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# Performance regression suite for the data processing tools.
+#
+# Runs each scenario on deterministic synthetic data (see generators.py), in its own process, and
+# records its runtime, throughput and peak resident memory as JSON.  Given a baseline (the JSON of
+# an earlier run on the same host, e.g. before a change is deployed), reports the scenarios that
+# got slower or bigger than the tolerance allows, and exits non-zero if there are any.
+#
+# Scenarios:
+#   tpm             TPMtool on a stranded sample (sense and antisense counts)
+#   fpkm            FPKMtool on a stranded sample
+#   tpm_matrix      TPMtool matrix mode on a collection of count files
+#   biom_split      the BIOM exporter's conversion of a sparse table into metadata and data files
+#   biom_collection the BIOM exporter's conversion of a multi-study collection of tables, in its process pool
+#   rnaseq_staging  RnaSeqExporter's manifest, dataset file staging and tarball, for a TPM collection
+#   rnaseq_matrix   the same, merging the collection into one expression matrix (the matrix layout)
+# Scenarios whose dependencies are not installed are recorded as skipped (and one skipped that the
+# baseline measured is a regression, so that a host that can run it doesn't stop unnoticed).
+#
+# usage: run_benchmarks.py [--scale F] [--repeat N] [--only NAME ...] [--output results.json]
+#                          [--baseline baseline.json] [--tolerance 0.25]
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import generators
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TOOLS_BIN = os.path.join(ROOT, "Tools", "bin")
+TOOLS_LIB = os.path.join(ROOT, "Tools", "lib", "python")
+
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(name, unit, **params):
+    """
+    Register a scenario.  Its setup function writes the scenario's input into a work directory and
+    returns the command to time and the number of units (of `unit`) it processes.  Integer params
+    are multiplied by --scale.
+    """
+    def register(setup):
+        SCENARIOS[name] = {"setup": setup, "unit": unit, "params": params}
+        return setup
+    return register
+
+
+def scaled(params, scale):
+    return {key: max(1, int(value * scale)) if isinstance(value, int) else value for key, value in params.items()}
+
+
+def tool_command(tool, *args):
+    return [sys.executable, os.path.join(TOOLS_BIN, tool)] + list(args)
+
+
+def child_command(name, **args):
+    return [sys.executable, os.path.abspath(__file__), "--child", name, json.dumps(args)]
+
+
+def gene_models(work, genes, rng):
+    """
+    :return: a GFF3 with this many genes, shared by the scenarios of a run
+    """
+    gff = os.path.join(work, "genes%d.gff3" % genes)
+    if not os.path.exists(gff):
+        generators.write_gff(gff, genes, rng)
+    return gff
+
+
+def stranded_sample(work, genes, rng):
+    sense, antisense = os.path.join(work, "sense%d.txt" % genes), os.path.join(work, "antisense%d.txt" % genes)
+    if not os.path.exists(sense):
+        generators.write_counts(sense, genes, rng)
+        generators.write_counts(antisense, genes, rng)
+    return sense, antisense
+
+
+@scenario("tpm", "genes", genes=60000)
+def setup_tpm(work, params, rng):
+    sense, antisense = stranded_sample(work, params["genes"], rng)
+    command = tool_command("TPMtool", "--genome", gene_models(work, params["genes"], rng), "--stranded",
+                           "--input", sense, "--output", os.path.join(work, "tpm.sense"),
+                           "--antisense_input", antisense, "--antisense_output", os.path.join(work, "tpm.antisense"))
+    return command, params["genes"]
+
+
+@scenario("fpkm", "genes", genes=60000)
+def setup_fpkm(work, params, rng):
+    sense, antisense = stranded_sample(work, params["genes"], rng)
+    command = tool_command("FPKMtool", "--genome", gene_models(work, params["genes"], rng), "--double_stranded", "y",
+                           "--input", sense, "--output", os.path.join(work, "fpkm.sense"),
+                           "--antisense_input", antisense, "--antisense_output", os.path.join(work, "fpkm.antisense"))
+    return command, params["genes"]
+
+
+@scenario("tpm_matrix", "samples", genes=60000, samples=24)
+def setup_tpm_matrix(work, params, rng):
+    collection = generators.write_counts_collection(os.path.join(work, "counts"), params["samples"], params["genes"], rng)
+    command = tool_command("TPMtool", "--genome", gene_models(work, params["genes"], rng),
+                           "--output_dir", os.path.join(work, "tpm_matrix"), "--matrix", os.path.join(work, "tpm_matrix.tsv"))
+    for name, path in collection:
+        command += ["--sample", name, path]
+    return command, params["samples"]
+
+
+@scenario("biom_split", "observations", observations=5000, samples=200, density=0.05)
+def setup_biom_split(work, params, rng):
+    biom = os.path.join(work, "table.biom")
+    generators.write_biom(biom, params["observations"], params["samples"], params["density"], rng)
+    return child_command("biom_split", biom=biom, output_dir=os.path.join(work, "biom_split")), params["observations"]
+
+
+@scenario("biom_collection", "tables", tables=6, observations=2000, samples=200, density=0.05)
+def setup_biom_collection(work, params, rng):
+    # tables of 1 to `tables` times the size of the smallest, as studies vary
+    tables = []
+    for t in range(params["tables"]):
+        biom = os.path.join(work, "study%d.biom" % t)
+        generators.write_biom(biom, params["observations"] * (t + 1), params["samples"], params["density"], rng)
+        tables.append((biom, "study %d.biom" % t))
+    return child_command("biom_collection", tables=tables, work=work), params["tables"]
+
+
+@scenario("rnaseq_matrix", "samples", genes=60000, samples=48, layout="matrix")
+@scenario("rnaseq_staging", "samples", genes=60000, samples=48, layout="per_file")
+def setup_rnaseq_staging(work, params, rng):
+    collection = generators.write_tpm_collection(os.path.join(work, "tpm_collection"), params["samples"], params["genes"], rng)
+    return child_command("rnaseq_staging", collection=collection, work=work, layout=params["layout"]), params["samples"]
+
+
+def child_biom_split(args):
+    try:
+        import biom.parse
+    except ImportError as e:
+        return {"skipped": "cannot import biom: " + str(e)}
+    from eupath import BiomFileMicrobiomeDbExporter
+
+    start = time.perf_counter()
+    BiomFileMicrobiomeDbExporter.convert_biom_file("table.biom", args["biom"], args["output_dir"])
+    return {"seconds": time.perf_counter() - start}
+
+
+def child_biom_collection(args):
+    try:
+        import biom.parse
+    except ImportError as e:
+        return {"skipped": "cannot import biom: " + str(e)}
+    from eupath import BiomFileMicrobiomeDbExporter, Progress, Scratch
+
+    # an exporter as initialize() would leave it, without contacting VDI
+    exporter = BiomFileMicrobiomeDbExporter.BiomExporter()
+    exporter._datasetInfos = [{"name": name, "path": path} for path, name in args["tables"]]
+    exporter._scratch = Scratch.ScratchManager([args["work"]])
+    exporter._progress = Progress.ProgressReporter()
+    exporter._config = {}
+
+    start = time.perf_counter()
+    with exporter.temporary_directory("bench_biom") as temp_path:
+        exporter.prepare_data_files(temp_path)
+    return {"seconds": time.perf_counter() - start}
+
+
+def child_rnaseq_staging(args):
+    try:
+        from eupath import RnaSeqEupathExporter, Progress, Scratch
+    except ImportError as e:
+        return {"skipped": "cannot import the RNA-Seq exporter: " + str(e)}
+
+    # an exporter as initialize() would leave it, without contacting VDI
+    exporter = RnaSeqEupathExporter.RnaSeqExporter()
+    exporter._refGenomeKey = "bench"
+    exporter._export_file_root = "bench_staging"
+    exporter._layout = args["layout"]
+    exporter._scratch = Scratch.ScratchManager([args["work"]])
+    exporter._progress = Progress.ProgressReporter()
+    # no upload history: the tarball is compressed for the default uplink bandwidth
+    exporter._config = {"upload-history": os.path.join(args["work"], "uploads.jsonl")}
+    type_specific_args = []
+    for name, path in args["collection"]:
+        type_specific_args += [path, name, "bench", "txt"]
+
+    start = time.perf_counter()
+    exporter._datasetInfos, exporter._matrixSamples, exporter._manifestLines = exporter.build_dataset_infos(type_specific_args)
+    with exporter.temporary_directory(exporter._export_file_root) as temp_path:
+        exporter.prepare_data_files(temp_path)
+        tarball_bytes = os.path.getsize(exporter.create_tarball(temp_path))
+    return {"seconds": time.perf_counter() - start, "tarball_mb": tarball_bytes / 1048576.0}
+
+
+CHILDREN = {"biom_split": child_biom_split, "biom_collection": child_biom_collection, "rnaseq_staging": child_rnaseq_staging}
+
+
+def measure(command, env):
+    """
+    Run a command, and get its wall time, or the time it reports (children print a JSON line), its
+    peak resident memory, and whatever else it reports
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+    output = process.stdout.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise SystemExit("Benchmark command failed: " + " ".join(command))
+
+    reported = {}
+    if command[2:3] == ["--child"]:
+        reported = json.loads(output.decode().strip().splitlines()[-1])
+    # ru_maxrss is in kilobytes on Linux
+    return reported.pop("seconds", elapsed), usage.ru_maxrss / 1024.0, reported
+
+
+def run_scenario(name, work, scale, repeat, env):
+    definition = SCENARIOS[name]
+    params = scaled(definition["params"], scale)
+    command, units = definition["setup"](work, params, random.Random(name))
+    result = {"params": params, "unit": definition["unit"]}
+
+    times, peaks = [], []
+    for i in range(repeat):
+        seconds, peak_rss_mb, reported = measure(command, env)
+        if "skipped" in reported:
+            result["skipped"] = reported["skipped"]
+            return result
+        times.append(seconds)
+        peaks.append(peak_rss_mb)
+    result.update({"seconds": min(times), "mean_seconds": sum(times) / len(times),
+                   "throughput": units / min(times), "peak_rss_mb": max(peaks)})
+    # other measurements the scenario reports, e.g. output sizes
+    result.update(reported)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: descriptions of the regressions of results against the baseline
+    """
+    regressions = []
+    for name, result in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous and "skipped" in result and "skipped" not in previous:
+            print("%-15s skipped, but measured in the baseline: %s" % (name, result["skipped"]))
+            regressions.append("%s skipped" % name)
+            continue
+        if not previous or "skipped" in result or "skipped" in previous:
+            continue
+        if previous["params"] != result["params"]:
+            print("%-15s not compared: parameters differ from the baseline" % name)
+            continue
+        for metric in ("seconds", "peak_rss_mb", "tarball_mb"):
+            if metric not in result or metric not in previous:
+                continue
+            ratio = result[metric] / previous[metric] if previous[metric] else 1.0
+            status = "REGRESSION" if ratio > 1 + tolerance else "ok"
+            print("%-15s %-11s %10.3f -> %10.3f (%+.1f%%) %s" % (name, metric, previous[metric], result[metric], (ratio - 1) * 100, status))
+            if ratio > 1 + tolerance:
+                regressions.append("%s %s %+.1f%%" % (name, metric, (ratio - 1) * 100))
+    return regressions
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        sys.path.insert(0, TOOLS_LIB)
+        print(json.dumps(CHILDREN[sys.argv[2]](json.loads(sys.argv[3]))))
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the scenarios' sizes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=list(SCENARIOS), help="scenarios to run (default all)")
+    parser.add_argument("--output", help="file to write the results JSON to")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed fractional increase in time or memory")
+    args = parser.parse_args()
+
+    results = {"created": datetime.datetime.now().isoformat(timespec="seconds"), "host": platform.node(),
+               "python": platform.python_version(), "scale": args.scale, "repeat": args.repeat, "scenarios": {}}
+    with tempfile.TemporaryDirectory() as work:
+        python_path = os.pathsep.join(filter(None, [TOOLS_LIB, os.getenv("PYTHONPATH")]))
+        env = dict(os.environ, PYTHONPATH=python_path, EUPATH_GENE_MODEL_CACHE=os.path.join(work, "gene_model_cache"))
+        env.pop("EUPATH_PROFILE", None)
+        for name in args.only or SCENARIOS:
+            result = run_scenario(name, work, args.scale, args.repeat, env)
+            results["scenarios"][name] = result
+            if "skipped" in result:
+                print("%-15s skipped: %s" % (name, result["skipped"]))
+            else:
+                print("%-15s %s best=%.3fs mean=%.3fs %.0f %s/s peak=%.1fMB%s" % (
+                    name, " ".join("%s=%s" % item for item in sorted(result["params"].items())), result["seconds"],
+                    result["mean_seconds"], result["throughput"], result["unit"], result["peak_rss_mb"],
+                    " tarball=%.1fMB" % result["tarball_mb"] if "tarball_mb" in result else ""))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        if regressions:
+            raise SystemExit("Performance regressions: " + ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()